@@ -0,0 +1,205 @@
+""" Relay feedback (Astrom-Hagglund) auto-tuning.
+
+    Instead of PID the element is driven as a relay around the target,
+    on for duty of the time while below, off while above. The bath
+    settles into a limit cycle whose amplitude a and period Pu give the
+    ultimate gain
+
+        Ku = 4d / (pi * sqrt(a^2 - e^2))
+
+    for relay amplitude d and hysteresis e, both expressed in the control
+    loop's energy units. A tuning rule (Tyreus-Luyben by default, it
+    overshoots less than Ziegler-Nichols on slow thermal plants) turns
+    Ku and Pu into gains, scaled by the divisor ControlLoop applies in its
+    normal stage, ready for the [Tuning] section.
+
+    The bath is read, and the relay pulsed, every sample_period seconds,
+    much finer than the control period, so the swing's peaks and switch
+    times are caught to within a second rather than a tenth of Pu.
+
+    python AutoTune.py --target 37 --write
+"""
+import re
+import math
+import time
+import argparse
+from ConfigParser import SafeConfigParser
+
+import numpy
+
+from Clock import monotonic
+from ControlLoop import staged_gains
+from Physics import resistance_to_watts, temperature_to_joules
+from Scheduler import CycleScheduler
+
+# Kp, Ti and Td as multiples of Ku and Pu
+RULES = {
+    'ziegler-nichols': (0.6, 0.5, 0.125),
+    'tyreus-luyben':   (1 / 2.2, 2.2, 1 / 6.3),
+    'pi':              (0.45, 1 / 1.2, 0.0),
+}
+
+
+class RelayAutoTune( object ):
+
+    def __init__(self, controller, target, watts, capacity, period=10.0, duty=0.2,
+                 hysteresis=0.05, cycles=4, max_duration=8 * 3600, rule='tyreus-luyben',
+                 clock=monotonic, sleep=time.sleep, verbose=True, sample_period=1.0):
+        """ watts - element power, capacity - joules per degree of the medium
+            period - the control loop's, which the gains are scaled to
+            sample_period - seconds between readings and relay pulses
+        """
+        self.controller = controller
+        self.target = target
+        self.watts = watts
+        self.capacity = capacity
+        self.period = period
+        self.sample_period = sample_period
+        self.duty = duty
+        self.hysteresis = hysteresis
+        self.cycles = cycles
+        self.max_duration = max_duration
+        self.rule = RULES[rule]
+        self.clock = clock
+        self.scheduler = CycleScheduler(sample_period, clock=clock, sleep=sleep)
+        self.verbose = verbose
+        self.times = []
+        self.temps = []
+        self.switches = []
+
+    def run(self):
+        """ Drive the relay until enough oscillations are seen, returns
+            the estimate from estimate()
+        """
+        relay_on = None
+        start = self.clock()
+        self.scheduler.start()
+        while len(self.switches) <= self.cycles:
+            if self.clock() - start > self.max_duration:
+                raise RuntimeError("No steady oscillation after {0:.0f}s".format(self.max_duration))
+            self.scheduler.wait()
+            t = self.controller.get_temperatures()
+            if t is not None:
+                now, temp = self.clock(), t[1]
+                self.times.append(now)
+                self.temps.append(temp)
+                if relay_on is None:
+                    relay_on = temp < self.target
+                elif relay_on and temp > self.target + self.hysteresis:
+                    relay_on = False
+                elif not relay_on and temp < self.target - self.hysteresis:
+                    relay_on = True
+                    self.switches.append(now)
+                    if self.verbose:
+                        print "Relay on at {0:.0f}s, {1} of {2}".format(
+                              now - start, len(self.switches), self.cycles + 1)
+            if relay_on:
+                self.controller.set_element_time(int(self.duty * self.sample_period * 1000))
+            self.scheduler.done()
+        return self.estimate()
+
+    def estimate(self):
+        """ Ultimate gain/period from the recorded limit cycle and the
+            PID gains from the tuning rule, in the loop's own units
+        """
+        times = numpy.asarray(self.times)
+        temps = numpy.asarray(self.temps)
+        amplitudes, periods = [], []
+        for t0, t1 in zip(self.switches[:-1], self.switches[1:]):
+            window = temps[(times >= t0) & (times < t1)]
+            if len(window):
+                amplitudes.append((window.max() - window.min()) / 2.0)
+                periods.append(t1 - t0)
+        # First cycle still carries the approach transient
+        if len(amplitudes) > 2:
+            amplitudes, periods = amplitudes[1:], periods[1:]
+        if not amplitudes:
+            raise RuntimeError("Not enough oscillation recorded")
+        a = numpy.mean(amplitudes) * self.capacity
+        e = self.hysteresis * self.capacity
+        # Relay swings between duty and nothing, joules per control period
+        d = self.watts * self.duty * self.period / 2.0
+        ku = 4 * d / (math.pi * math.sqrt(max(a**2 - e**2, (a / 10.0)**2)))
+        pu = float(numpy.mean(periods))
+        kp, ti, td = self.rule
+        kp, ti, td = kp * ku, ti * pu, td * pu
+        return {'ku': ku, 'pu': pu,
+                'amplitude': float(numpy.mean(amplitudes)),
+                'kp': kp, 'ki': kp / ti, 'kd': kp * td}
+
+
+def suggested_tuning(result, divisor=None):
+    """ P/I/D settings that give the estimated gains once ControlLoop
+        divides them by its normal stage divisor, the stages closer to
+        target scale them down further
+    """
+    if divisor is None:
+        divisor = staged_gains(1.0, 1.0)[1]
+    return {'P': result['kp'] * divisor,
+            'I': result['ki'] * divisor,
+            'D': result['kd'] * divisor}
+
+
+def update_config(path, section, values):
+    """ Rewrite options in place, keeping the file's layout and comments """
+    with open(path) as f:
+        lines = f.readlines()
+    current, done = None, set()
+    for n, line in enumerate(lines):
+        header = re.match(r'\s*\[(.+)\]', line)
+        if header:
+            current = header.group(1)
+            continue
+        option = re.match(r'(\s*)([^#;\s:=]+)(\s*[:=]\s*)', line)
+        if current == section and option and option.group(2) in values:
+            lines[n] = '{0}{1}{2}{3}\n'.format(option.group(1), option.group(2),
+                                               option.group(3), values[option.group(2)])
+            done.add(option.group(2))
+    missing = [k for k in values if k not in done]
+    if missing:
+        raise KeyError("[{0}] has no {1}".format(section, ', '.join(missing)))
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+
+if __name__ == "__main__":
+    from BathController import BathController
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='config.conf')
+    parser.add_argument('--section', default='Tuning')
+    parser.add_argument('--target', type=float, required=True)
+    parser.add_argument('--period', type=float, default=10.0,
+                        help="control period the gains are for")
+    parser.add_argument('--sample-period', type=float, default=1.0,
+                        help="seconds between readings while relaying")
+    parser.add_argument('--duty', type=float, default=0.2,
+                        help="fraction of each period the element is on")
+    parser.add_argument('--rule', choices=sorted(RULES), default='tyreus-luyben')
+    parser.add_argument('--hysteresis', type=float, default=0.05)
+    parser.add_argument('--cycles', type=int, default=4)
+    parser.add_argument('--write', action='store_true',
+                        help="store the suggested gains in the config")
+    args = parser.parse_args()
+
+    config = SafeConfigParser()
+    config.read(args.config)
+    get = lambda option: float(config.get(args.section, option))
+    controller = BathController(config.get('Connection', 'Port'),
+                                config.get('Connection', 'Baud'))
+    time.sleep(3)
+    tuner = RelayAutoTune(controller, args.target,
+                          resistance_to_watts(get('Resistance'), get('Voltage')),
+                          temperature_to_joules(1.0, 0.0, get('Mass'), get('Heat_Capacity')),
+                          args.period, args.duty, args.hysteresis, args.cycles,
+                          rule=args.rule, sample_period=args.sample_period)
+    result = tuner.run()
+    tuning = suggested_tuning(result)
+    print "Ku {0:.4g}, Pu {1:.0f}s, amplitude {2:.3f}'c".format(
+          result['ku'], result['pu'], result['amplitude'])
+    print "Suggested [{0}] P: {1:.4f} I: {2:.4f} D: {3:.4f}".format(
+          args.section, tuning['P'], tuning['I'], tuning['D'])
+    if args.write:
+        update_config(args.config, args.section,
+                      dict((k, '{0:.4f}'.format(v)) for k, v in tuning.items()))
+        print "Written to {0}".format(args.config)
@@ -1,25 +1,117 @@
-import struct
-import serial
 import time
+import Queue
+import threading
+
+import numpy
+
+from Clock import monotonic
+from Metrics import Counter, Histogram
+from PacketCodec import (PacketCodec, TELEMETRY, TELEMETRY_IR, ELEMENT_TIME, TEMPERATURES,
+                         IR_TEMPERATURE, STREAM_PERIOD, RAW_SAMPLES, FRAME_START, valid)
+from RingBuffer import RingBuffer
+import Trace
+from SerialTransport import SerialTransport, Transport_Timeout
 
 class Hardware_Exeption(Exception):
     pass
 
+# Request bytes by name, for the round trip metric
+STEP_NAMES = {b"\x05": 'ENQ', b"\x11": 'DC1', b"\x12": 'DC2', b"\x13": 'DC3',
+              b"\x14": 'DC4', b"\x17": 'ETB'}
+
+TRANSACTION_SECONDS = Histogram('pybath_transaction_seconds',
+                                "Request to reply round trip, by protocol step",
+                                ('port', 'step'))
+CHECKSUM_FAILURES = Counter('pybath_checksum_failures_total',
+                            "Packets and frames that failed their checksum or CRC",
+                            ('port',))
+NAKS = Counter('pybath_naks_total', "Requests the board refused", ('port',))
+TIMEOUTS = Counter('pybath_timeouts_total', "Requests the board didn't answer in time",
+                   ('port',))
+TELEMETRY_FRAMES = Counter('pybath_telemetry_frames_total', "Pushed telemetry frames decoded",
+                           ('port',))
+
+
 class BathController( object ):
 
-	def __init__(self, port, baud, timeout=5):
+	def __init__(self, port, baud, timeout=5, protocol=None, thermistor=None):
+		"""
+		thermistor - a Thermistor, when the firmware offers raw ADC mode
+		the bath reading is sent as ADC counts and converted here
+		"""
 
 		self.temperature_request = b"\x11" # DC1
 		self.set_element_request = b"\x12" # DC2
+		self.element_temp_request = b"\x13" # DC3
+		self.stream_request      = b"\x14" # DC4, v2 only
+		self.telemetry_frame     = b"\x16" # SYN, pushed while streaming
 		self.success_accept      = b"\x06" # ACK
 		self.ready_request       = b"\x05" # ENQ
 		self.fail_deny           = b"\x15" # NAK
 		self.emergency_stop      = b"\x18"#  CAN
+		self.frame_start         = FRAME_START # STX, protocol v2 frames
+		self.raw_adc_request     = b"\x17" # ETB, v2 only, raw bath readings
+
+		# Firmware feature bits, byte 4 of the temperature packet
+		self.feature_element_temp = 0x01
+		self.feature_v2           = 0x02
+		self.feature_stream       = 0x04
+		self.feature_raw_adc      = 0x08
+		# Set in replies whose bath reading is raw counts
+		self.feature_raw_active   = 0x10
+		# An IR reading of the bath follows the features byte
+		self.feature_ir           = 0x20
+		self.features = 0
+		# Latest IR bath reading, None when the firmware has no IR
+		# sensor or hasn't got a reading yet
+		self.ir_temp = None
+		self.thermistor = thermistor
+		self.raw_requested = False
+		# None - start on v1 and move to v2 if the firmware offers it
+		self.allowed_protocol = protocol
+		self.protocol = 1
 
 		self.port = port
 		self.baud = baud
 		self.timeout = timeout
-		self.comline = serial.Serial(self.port, self.baud, timeout=self.timeout)
+		self.transport = SerialTransport(self.port, self.baud, timeout=self.timeout)
+		self.comline = self.transport.comline
+		# Packet layouts and the buffers they are read into, see PacketCodec.py
+		self.codec = PacketCodec()
+
+		# Streaming telemetry, see start_streaming()
+		self.lock = threading.Lock()
+		self.reader = None
+		self.replies = Queue.Queue()
+		self.samples = None
+		self.stream_period = None
+		self.telemetry = TELEMETRY
+
+		self._checksum_failures = CHECKSUM_FAILURES.labels(port=port)
+		self._naks = NAKS.labels(port=port)
+		self._timeouts = TIMEOUTS.labels(port=port)
+		self._telemetry_frames = TELEMETRY_FRAMES.labels(port=port)
+
+
+	def _request(self, request, message, deadline):
+		""" Send a request byte, raise unless the hardware ACKs it """
+		start = monotonic()
+		self.transport.write(request, deadline)
+		try:
+			reply = self.transport.read(1, deadline)
+		except Transport_Timeout:
+			self._timeouts.inc()
+			raise Hardware_Exeption(message + " (timed out)")
+		# Anything longer than a request byte is a (bytearray) packet
+		step = STEP_NAMES.get(request) if len(request) == 1 else None
+		self._round_trip(step or 'element packet', start)
+		if reply != self.success_accept:
+			self._naks.inc()
+			raise Hardware_Exeption(message)
+
+
+	def _round_trip( self, step, start ):
+		TRANSACTION_SECONDS.labels(port=self.port, step=step).observe(monotonic() - start)
 
 
 	def get_temperatures( self ):
@@ -35,41 +127,56 @@ class BathController( object ):
 			HW - if NAK resend, if 3 NAKs - failsafe shutdown
 			PC - Listen until failsafe
 		"""
-		self.comline.flushInput()
-		self.comline.flushOutput()
-		self.comline.write(self.ready_request)
+		if self.reader is not None:
+			return self._latest_sample()
+		if self.protocol == 2:
+			return self._temperatures_v2(self.temperature_request)
+		deadline = self.transport.deadline()
+		self.transport.flush()
 		# Shutdown if request denied
-		while self.comline.inWaiting() < 1: pass
-		reply = self.comline.read(1)
-		reply = struct.unpack('B', str(reply))[0]
-		if reply != struct.unpack('B', self.success_accept)[0]:
-			raise Hardware_Exeption("Ready request denied for temperature data")
+		self._request(self.ready_request,
+		              "Ready request denied for temperature data", deadline)
 		#Request temperature data
-		self.comline.write(self.temperature_request)
-		# Shutdown if request denied
-		while self.comline.inWaiting() < 1: pass
-		reply = self.comline.read(1)
-		reply = struct.unpack('B', str(reply))[0]
-		if reply != struct.unpack('B', self.success_accept)[0]:
-			raise Hardware_Exeption("Request denied for temperature data")
+		self._request(self.temperature_request,
+		              "Request denied for temperature data", deadline)
+		return self._read_temperatures(deadline)
+
+
+	def _read_temperatures( self, deadline ):
+		""" Read, check and ACK a temperature packet """
 		# Get temperature data packet
-		while self.comline.inWaiting() < 64: pass
-		data = self.comline.read(64)
-		data = struct.unpack('B'*64, data)
+		start = monotonic()
+		try:
+			self.transport.readinto(self.codec.packet_view, deadline)
+		except Transport_Timeout:
+			self._timeouts.inc()
+			raise Hardware_Exeption("Temperature data packet timed out")
+		self._round_trip('packet', start)
 		# Check packet integrity
-		if not self.checksum(data): 
-			print "Checksum fail...\n{0}".format(data)
+		data = self.codec.decode_temperatures()
+		if data is None: 
+			self._checksum_failures.inc()
+			print "Checksum fail...\n{0}".format(list(self.codec.packet))
 			# Will ensure element turns off until we sort the issue
 			# self.comline.write(self.fail_deny)
 			# Get temperature data packet
 			return
 		# Extract and scale temperatures
-		environment_temperature = ((data[0] << 8) + (data[1]))/100.0
-		bath_temperature = ((data[2] << 8) + (data[3]))/100.0
-		self.comline.write(self.success_accept)
+		environment_temperature = data[0]/100.0
+		bath_temperature = data[1]/100.0
+		# What the firmware can do, zero padding on old builds
+		self._negotiate(data[2])
+		self.ir_temp = self._ir_temperature(data[3], data[2])
+		self.transport.write(self.success_accept, deadline)
 		return environment_temperature, bath_temperature
 
 
+	def _negotiate( self, features ):
+		self.features = features
+		if self.allowed_protocol in (None, 2) and features & self.feature_v2:
+			self.protocol = 2
+
+
 	def set_element_time( self , on_time):
 		"""
 		PC - Ready request
@@ -79,53 +186,298 @@ class BathController( object ):
 		PC - send uint32_t millis of element ON time
 		HW - ACK/NAK
 		"""
-		self.comline.flushInput()
-		self.comline.flushOutput()
-		self.comline.write(self.ready_request)
-		while self.comline.inWaiting() < 1: pass
-		reply = self.comline.read(1)
-		# Shutdown if request denied
-		reply = struct.unpack('B', str(reply))[0]
-		if reply != struct.unpack('B', self.success_accept)[0]:
-			raise Hardware_Exeption("Ready request denied for element time operation") 
-		# Request element time
-		self.comline.write(self.set_element_request)
-		# Read reply
-		while self.comline.inWaiting() < 1: pass
-		reply = self.comline.read(1)
-		# Shutdown if request denied
-		reply = struct.unpack('B', str(reply))[0]
-		if reply != struct.unpack('B', self.success_accept)[0]:
-			raise Hardware_Exeption("Element time request failed or denied")
-		#Structure and pack data into serial payload
-		b1 = on_time >> (3*8) & 0xFF
-		b2 = on_time >> (2*8) & 0xFF
-		b3 = on_time >> 8 & 0xFF
-		b4 = on_time & 0xFF
-		################################## checksum 
-		csum = self.checksum([b1,b2,b3,b4], check=False)
-		payload = struct.pack('4B59xB', b1,b2,b3,b4,csum)		
-		# Send it...
-		self.comline.write(payload)
-		# Read reply
-		while self.comline.inWaiting() < 1: pass
-		reply = self.comline.read(1)
-		# Shutdown if request denied
-		reply = struct.unpack('B', str(reply))[0]
-		if reply != struct.unpack('B', self.success_accept)[0]:
-			raise Hardware_Exeption("Element time packet failed")
-		return
+		with Trace.span('set_element_time', on_time=on_time):
+			if self.protocol == 2:
+				self._transaction_v2(self.set_element_request,
+				                     ELEMENT_TIME.pack(on_time),
+				                     "Element time packet failed")
+				return
+			deadline = self.transport.deadline()
+			self.transport.flush()
+			# Shutdown if request denied
+			self._request(self.ready_request,
+			              "Ready request denied for element time operation", deadline)
+			# Request element time
+			self._request(self.set_element_request,
+			              "Element time request failed or denied", deadline)
+			# Send it, one write for the whole frame
+			self._request(self._element_packet(on_time),
+			              "Element time packet failed", deadline)
+			return
+
+
+	def set_element_and_get_temperatures( self, on_time ):
+		"""
+		PC - Ready request + element_temp_request
+		HW - ACK/NAK, ACK/NAK
+		PC - send uint32_t millis of element ON time
+		HW - ACK/NAK
+		HW - send binary packed temperatures and checksum
+		PC - ACK / NAK
+		Falls back to set_element_time() then get_temperatures()
+		on firmware that doesn't advertise the combined request.
+		"""
+		with Trace.span('set_element_and_get_temperatures', on_time=on_time):
+			if self.reader is not None:
+				self.set_element_time(on_time)
+				return self._latest_sample()
+			if self.protocol == 2:
+				return self._temperatures_v2(self.element_temp_request,
+				                             ELEMENT_TIME.pack(on_time))
+			if not self.features & self.feature_element_temp:
+				self.set_element_time(on_time)
+				return self.get_temperatures()
+			deadline = self.transport.deadline()
+			self.transport.flush()
+			# Both request bytes go out together, the firmware reads
+			# DC3 as soon as it has ACK'd the ENQ
+			start = monotonic()
+			self.transport.write(self.ready_request + self.element_temp_request, deadline)
+			for step, message in (('ENQ', "Ready request denied for element/temperature operation"),
+			                      ('DC3', "Element/temperature request failed or denied")):
+				try:
+					reply = self.transport.read(1, deadline)
+				except Transport_Timeout:
+					self._timeouts.inc()
+					raise Hardware_Exeption(message + " (timed out)")
+				self._round_trip(step, start)
+				if reply != self.success_accept:
+					self._naks.inc()
+					raise Hardware_Exeption(message)
+			self._request(self._element_packet(on_time),
+			              "Element time packet failed", deadline)
+			return self._read_temperatures(deadline)
+
+
+	def _transaction_v2( self, command, data, message ):
+		"""
+		PC - STX, length, command, data, CRC-16
+		HW - STX, length, ACK/NAK, data, CRC-16
+		Returns the reply data. A reply that fails its CRC could have
+		been a NAK, so only a temperature request gets None for it (a
+		missed reading, like a bad v1 checksum), anything else raises.
+		"""
+		deadline = self.transport.deadline()
+		start = monotonic()
+		with self.lock:
+			# Built in the codec's buffer, so under the lock
+			frame = self.codec.encode_frame(command, data)
+			try:
+				if self.reader is None:
+					self.transport.flush()
+					self.transport.write(frame, deadline)
+					if self.transport.read(1, deadline) != self.frame_start:
+						raise Hardware_Exeption(message + " (bad frame)")
+					body = self._read_frame(deadline)
+				else:
+					# The reader thread owns the input side, anything
+					# queued is left over from a timed out request
+					while not self.replies.empty():
+						self.replies.get_nowait()
+					self.transport.write(frame, deadline)
+					body = self.replies.get(timeout=max(0, deadline - monotonic()))
+			except (Transport_Timeout, Queue.Empty):
+				self._timeouts.inc()
+				raise Hardware_Exeption(message + " (timed out)")
+		self._round_trip('v2 ' + STEP_NAMES.get(command, repr(command)), start)
+		if body is None:
+			if command in (self.temperature_request, self.element_temp_request):
+				return
+			raise Hardware_Exeption(message + " (CRC fail)")
+		if body[:1] != self.success_accept:
+			self._naks.inc()
+			raise Hardware_Exeption(message)
+		return body[1:]
+
+
+	def _read_frame( self, deadline ):
+		""" Rest of a v2 frame after the STX, status and data,
+		    None if it failed the CRC.
+		"""
+		length = self.transport.read(1, deadline)
+		body = length + self.transport.read(ord(length) + 2, deadline)
+		reply = self.codec.check_frame(body)
+		if reply is None:
+			self._checksum_failures.inc()
+			print "CRC fail...\n{0}".format(repr(body))
+		return reply
+
+
+	def start_streaming( self, period_ms, capacity=4096 ):
+		"""
+		Have the firmware push a timestamped temperature frame every
+		period_ms. A reader thread decodes them into self.samples, after
+		which get_temperatures() returns the newest sample without
+		touching the serial line.
+		"""
+		if self.protocol != 2 or not self.features & self.feature_stream:
+			raise Hardware_Exeption("Firmware does not support streaming")
+		if self.reader is not None:
+			self.stop_streaming()
+		# Frames only carry raw counts if asked before the stream starts
+		self._raw_adc_if_wanted()
+		if self.samples is None or self.samples.capacity != capacity:
+			self.samples = RingBuffer(capacity, ('time', 'device_time',
+			                                     'env_temp', 'bath_temp', 'ir_temp'))
+		# Frames carry the IR reading when the firmware has one
+		self.telemetry = TELEMETRY_IR if self.features & self.feature_ir else TELEMETRY
+		self._transaction_v2(self.stream_request, STREAM_PERIOD.pack(period_ms),
+		                     "Stream request denied")
+		self.stream_period = period_ms / 1000.0
+		self.reader = threading.Thread(target=self._stream_reader)
+		self.reader.daemon = True
+		self.reader.start()
+
+
+	def stop_streaming( self ):
+		if self.reader is None:
+			return
+		try:
+			self._transaction_v2(self.stream_request, STREAM_PERIOD.pack(0),
+			                     "Stream stop denied")
+		finally:
+			reader, self.reader = self.reader, None
+			reader.join()
+			self.transport.flush()
+
+
+	def _stream_reader( self ):
+		""" Route incoming frames, telemetry to the ring, the rest to
+		    whoever is waiting in _transaction_v2()
+		"""
+		self._wraps, self._last_ms = 0, 0
+		batch = []
+		while self.reader is threading.current_thread():
+			try:
+				# Short deadline so stop_streaming() is noticed, none at
+				# all while draining frames that are already here
+				wait = 0 if batch else 0.25
+				if self.transport.read(1, self.transport.deadline(wait)) != self.frame_start:
+					continue
+				# A whole frame is well under a millisecond on the wire,
+				# so don't hold up stop_streaming() for the full timeout
+				body = self._read_frame(self.transport.deadline(0.25))
+			except Transport_Timeout:
+				if batch:
+					self._store_telemetry(batch)
+					batch = []
+				continue
+			except (IOError, OSError):
+				self.reader = None
+				break
+			if body is None:
+				continue
+			if body[:1] != self.telemetry_frame:
+				self.replies.put(body)
+				continue
+			batch.append(body[1:1 + self.telemetry.itemsize])
+			if len(batch) >= 256:
+				self._store_telemetry(batch)
+				batch = []
+
+
+	def _store_telemetry( self, batch ):
+		""" Decode a run of telemetry frames in one go into the ring """
+		frames = numpy.frombuffer(b"".join(batch), dtype=self.telemetry)
+		self._telemetry_frames.inc(len(frames))
+		device_ms = frames['device_ms'].astype(float)
+		# millis() wraps after ~49 days
+		steps = numpy.diff(numpy.concatenate(([self._last_ms], device_ms))) < 0
+		wraps = self._wraps + numpy.cumsum(steps)
+		self._wraps, self._last_ms = int(wraps[-1]), device_ms[-1]
+		device_time = (wraps * 2.0**32 + device_ms) / 1000.0
+		# Arrival times, spread back from now by the device's own clock
+		now = monotonic()
+		self.samples.extend((now - (device_time[-1] - device_time), device_time,
+		                    frames['env'] / 100.0,
+		                    self._bath_temperature(frames['bath'], frames['features']),
+		                    self._ir_temperature(frames['ir'] if 'ir' in frames.dtype.names
+		                                         else numpy.zeros(len(frames)), frames['features'])))
+
+
+	def _latest_sample( self ):
+		sample = self.samples.latest()
+		if sample is None:
+			return
+		if monotonic() - sample[0] > max(self.timeout, 3 * self.stream_period):
+			raise Hardware_Exeption("Telemetry stream stalled")
+		self.ir_temp = None if numpy.isnan(sample[4]) else sample[4]
+		return sample[2], sample[3]
+
+
+	def _raw_adc_if_wanted( self ):
+		""" Raw ADC mode once, when there's a thermistor to convert with """
+		if (self.thermistor is not None and not self.raw_requested
+		        and self.features & self.feature_raw_adc):
+			self.enable_raw_adc()
+
+
+	def _temperatures_v2( self, command, data=b"" ):
+		self._raw_adc_if_wanted()
+		reply = self._transaction_v2(command, data,
+		                             "Request denied for temperature data")
+		if reply is None:
+			return
+		env, bath, features = TEMPERATURES.unpack_from(reply)
+		self.features = features
+		ir = (IR_TEMPERATURE.unpack_from(reply, TEMPERATURES.size)[0]
+		      if len(reply) >= TEMPERATURES.size + IR_TEMPERATURE.size else 0)
+		self.ir_temp = self._ir_temperature(ir, features)
+		return env/100.0, float(self._bath_temperature(bath, features))
+
+
+	def enable_raw_adc( self, samples=None ):
+		"""
+		Have the firmware report the sum of its last samples bath ADC
+		readings (default the thermistor's) instead of converting them
+		itself, 0 goes back to on-board conversion.
+		"""
+		if samples is None:
+			samples = self.thermistor.samples if self.thermistor is not None else 0
+		if samples and self.thermistor is None:
+			raise Hardware_Exeption("Raw ADC mode needs a thermistor to convert with")
+		if self.protocol != 2 or not self.features & self.feature_raw_adc:
+			raise Hardware_Exeption("Firmware does not support raw ADC mode")
+		self.raw_requested = True
+		self._transaction_v2(self.raw_adc_request, RAW_SAMPLES.pack(samples),
+		                     "Raw ADC request denied")
+
+
+	def _bath_temperature( self, bath, features ):
+		""" Bath field(s) to degrees, by table lookup where the firmware
+		    sent raw counts. Scalar or array.
+		"""
+		raw = numpy.asarray(features) & self.feature_raw_active
+		if self.thermistor is None or not raw.any():
+			return numpy.asarray(bath) / 100.0
+		return numpy.where(raw, self.thermistor.celsius(bath), numpy.asarray(bath) / 100.0)
+
+
+	def _ir_temperature( self, ir, features ):
+		""" IR field(s) to degrees, None (NaN for arrays) where the
+		    firmware has no IR sensor or no reading yet
+		"""
+		if numpy.ndim(ir) == 0:
+			return ir/100.0 if ir and features & self.feature_ir else None
+		good = (numpy.asarray(ir) > 0) & ((numpy.asarray(features) & self.feature_ir) > 0)
+		return numpy.where(good, numpy.asarray(ir) / 100.0, numpy.nan)
+
+
+	def _element_packet( self, on_time ):
+		# Packed with its checksum into the codec's buffer
+		return self.codec.encode_element(on_time)
+
+	def close( self ):
+		if self.reader is not None:
+			self.stop_streaming()
+		self.transport.close()
 
 	def checksum(self, data, check=True):
 		# check = true returns checksum validation
-		#       = false returns calc'd checksum of data[:-1] 
-		t = 0
+		#       = false returns calc'd checksum of data
 		if check:
-			for i in data[:-1]: t += i
-			return (t % 255) == data[-1]
-		else:
-			for i in data: t += i
-			return (t % 255)
+			return valid(bytearray(data))
+		return sum(bytearray(data)) % 255
 
 
 if __name__ == '__main__':
@@ -0,0 +1,192 @@
+""" Throughput and latency of the host protocol and control hot paths.
+
+    python Benchmark.py --json bench.json
+    python Benchmark.py --only codec pid
+
+    Serial benchmarks run BathController against the firmware emulator on
+    a pseudo-terminal, once as v1 firmware and once as v2. A pty ignores
+    the baud rate, so those numbers are the host side cost (syscalls,
+    framing, checksums, the emulator's replies) rather than wire time,
+    which at 250000 baud adds about 40us per byte.
+
+    Every benchmark reports calls per second and per call latency
+    percentiles in microseconds, written as JSON along with the commit and
+    interpreter so runs can be compared between commits.
+"""
+import sys
+import json
+import time
+import platform
+import contextlib
+import argparse
+import subprocess
+import multiprocessing
+from ConfigParser import SafeConfigParser
+
+import numpy
+
+import PID
+from BathController import BathController
+from Clock import VirtualClock, monotonic
+from ControlLoop import tuning_state
+from Emulator import FirmwareEmulator, FEATURE_ELEMENT_TEMP, FEATURE_V2
+from PacketCodec import crc16, valid
+from Plant import BathPlant
+from SharedState import SharedState
+
+
+def measure(function, iterations):
+    """ Call function iterations times, returns its rate and latency
+        percentiles
+    """
+    times = numpy.empty(iterations)
+    start = monotonic()
+    for i in xrange(iterations):
+        t = monotonic()
+        function()
+        times[i] = monotonic() - t
+    elapsed = monotonic() - start
+    us = times * 1e6
+    return {'iterations': iterations,
+            'calls_per_second': iterations / elapsed,
+            'mean_us': float(us.mean()),
+            'p50_us': float(numpy.percentile(us, 50)),
+            'p90_us': float(numpy.percentile(us, 90)),
+            'p99_us': float(numpy.percentile(us, 99)),
+            'max_us': float(us.max())}
+
+
+def bench_codec(controller, iterations):
+    """ Packet checksums, encode and decode, no I/O """
+    # A temperature packet as the firmware sends it
+    reply = bytearray(64)
+    reply[0:5] = [0x08, 0x34, 0x0E, 0x74, 0x00]
+    reply[63] = sum(reply[:63]) % 255
+    reply = bytes(reply)
+    codec = controller.codec
+    codec.packet[:] = reply
+    body = b"\x06\x06\x11\x08\x34\x0e\x74\x03"
+
+    return {'checksum_check': measure(lambda: valid(codec.packet), iterations),
+            'element_packet_encode': measure(lambda: controller._element_packet(1234),
+                                             iterations),
+            'temperature_packet_decode': measure(codec.decode_temperatures, iterations),
+            'frame_encode': measure(lambda: codec.encode_frame(0x12, b"\x00\x00\x04\xd2"),
+                                    iterations),
+            'crc16_frame': measure(lambda: crc16(body), iterations)}
+
+
+def bench_pid(iterations):
+    pid = PID.control(0.1, 0.07, 0.1)
+    error = [1000.0]
+    def step():
+        error[0] *= 0.999
+        pid.genOut(error[0])
+    return {'genOut': measure(step, iterations)}
+
+
+def bench_state(config, iterations):
+    """ SharedState against the Manager dict it replaced """
+    state = SharedState(tuning_state(config))
+    results = {'shared_get': measure(lambda: state['bath_temp'], iterations),
+               'shared_set': measure(lambda: state.__setitem__('bath_temp', 37.0), iterations),
+               'shared_update': measure(lambda: state.update(env_temp=21.0, bath_temp=37.0,
+                                                             data_fresh=True), iterations),
+               'shared_snapshot': measure(state.snapshot, iterations)}
+    manager = multiprocessing.Manager()
+    try:
+        proxy = manager.dict(tuning_state(config))
+        # Each access is a round trip to the manager process, keep it short
+        n = max(iterations // 10, 1)
+        results['manager_get'] = measure(lambda: proxy['bath_temp'], n)
+        results['manager_set'] = measure(lambda: proxy.__setitem__('bath_temp', 37.0), n)
+    finally:
+        manager.shutdown()
+    return results
+
+
+@contextlib.contextmanager
+def emulated(config, features, baud):
+    """ A BathController talking to the emulator advertising features,
+        protocol already negotiated
+    """
+    plant = BathPlant.from_config(config, VirtualClock(1.0), env_temp=21.0, bath_temp=21.0)
+    emulator = FirmwareEmulator(plant, features=features)
+    controller = BathController(emulator.start(), baud)
+    try:
+        controller.get_temperatures()
+        yield controller
+    finally:
+        controller.set_element_time(0)
+        controller.close()
+        emulator.stop()
+
+
+def bench_serial(controller, iterations):
+    return {'protocol': controller.protocol,
+            'get_temperatures': measure(controller.get_temperatures, iterations),
+            'set_element_time': measure(lambda: controller.set_element_time(1), iterations),
+            'set_element_and_get_temperatures': measure(
+                lambda: controller.set_element_and_get_temperatures(1), iterations)}
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+GROUPS = ('codec', 'pid', 'state', 'serial')
+FIRMWARE = (('serial_v1', 0), ('serial_v2', FEATURE_ELEMENT_TEMP | FEATURE_V2))
+
+
+def run(config, groups=GROUPS, iterations=20000, serial_iterations=500, baud=250000):
+    results = {}
+    if 'serial' in groups:
+        for name, features in FIRMWARE:
+            with emulated(config, features, baud) as controller:
+                results[name] = bench_serial(controller, serial_iterations)
+    if 'codec' in groups:
+        with emulated(config, 0, baud) as controller:
+            results['codec'] = bench_codec(controller, iterations)
+    if 'pid' in groups:
+        results['pid'] = bench_pid(iterations)
+    if 'state' in groups:
+        results['state'] = bench_state(config, iterations)
+    return {'meta': {'commit': commit(), 'time': time.time(),
+                     'python': platform.python_version(), 'platform': platform.platform(),
+                     'numpy': numpy.__version__, 'baud': baud, 'iterations': iterations,
+                     'serial_iterations': serial_iterations},
+            'results': results}
+
+
+def report(results, prefix=''):
+    for name, value in sorted(results.items()):
+        if isinstance(value, dict) and 'calls_per_second' in value:
+            print "{0:<48} {1:>12.0f}/s  p50 {2:>9.1f}us  p99 {3:>9.1f}us".format(
+                  prefix + name, value['calls_per_second'], value['p50_us'], value['p99_us'])
+        elif isinstance(value, dict):
+            report(value, prefix + name + '.')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='config.conf')
+    parser.add_argument('--only', nargs='+', choices=GROUPS, default=GROUPS)
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--serial-iterations', type=int, default=500)
+    parser.add_argument('--baud', type=int, default=250000)
+    parser.add_argument('--json', help="write the results here, - for stdout")
+    args = parser.parse_args()
+
+    config = SafeConfigParser()
+    config.read(args.config)
+    out = run(config, args.only, args.iterations, args.serial_iterations, args.baud)
+    if args.json == '-':
+        json.dump(out, sys.stdout, indent=1, sort_keys=True)
+    else:
+        report(out['results'])
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(out, f, indent=1, sort_keys=True)
@@ -0,0 +1,71 @@
+import time
+import ctypes
+import ctypes.util
+
+CLOCK_MONOTONIC = 1 # linux/time.h
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _clock_gettime():
+    """ Bind clock_gettime(2) from libc, python 2 has no time.monotonic """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = libc.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    ts = _timespec()
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = _clock_gettime()
+
+
+class VirtualClock( object ):
+    """ Simulated time, callable like a clock function.
+
+        speed - how many simulated seconds pass per real second, None
+                for a stepped clock that only moves on sleep()/advance()
+                so a simulation runs as fast as it can compute.
+    """
+
+    def __init__(self, speed=1.0, start=0.0):
+        self.speed = speed
+        self.start = start
+        self.offset = 0.0
+        self.origin = monotonic()
+
+    def __call__(self):
+        if self.speed is None:
+            return self.start + self.offset
+        return self.start + self.offset + (monotonic() - self.origin) * self.speed
+
+    def advance(self, seconds):
+        """ Jump simulated time forward """
+        self.offset += seconds
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        if self.speed is None:
+            self.advance(seconds)
+        else:
+            time.sleep(seconds / self.speed)
+
+
+def from_config(config, section='Connection'):
+    """ A VirtualClock at the section's Speed, for a host driving
+        Emulator.py faster than real time. None, real time, when Speed
+        is unset or 1.
+    """
+    if not config.has_option(section, 'Speed'):
+        return None
+    speed = config.getfloat(section, 'Speed')
+    return None if speed == 1.0 else VirtualClock(speed)
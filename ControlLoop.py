@@ -0,0 +1,317 @@
+import math
+import time
+
+import PID
+from Clock import monotonic
+from Metrics import Counter, Histogram
+import Trace
+from Recorder import CONTROL_MODES
+from Scheduler import CycleScheduler
+from Physics import resistance_to_watts, joules_to_watt_seconds, \
+                    temperature_to_joules, boltzmann_loss
+
+CYCLE_SECONDS = Histogram('pybath_cycle_seconds', "Control cycle execution time", ('bath',))
+CYCLE_OVERRUNS = Counter('pybath_cycle_overruns_total',
+                         "Cycles that ran past the next deadline", ('bath',))
+ELEMENT_REQUESTED = Counter('pybath_element_requested_seconds_total',
+                            "Element on-time the energy model and PID asked for", ('bath',))
+ELEMENT_ISSUED = Counter('pybath_element_issued_seconds_total',
+                         "Element on-time sent to the board", ('bath',))
+ELEMENT_CLAMPED = Counter('pybath_element_clamped_total',
+                          "Cycles whose element time was clamped", ('bath',))
+STATE_ACCESS_SECONDS = Histogram('pybath_state_access_seconds',
+                                 "Time to read or write the bath's shared state",
+                                 ('bath', 'op'),
+                                 buckets=(1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 1e-3, 1e-2))
+
+
+def tuning_state(config, section='Tuning'):
+    """ Initial (name, value) pairs of a bath's SharedState """
+    return [
+            ('env_temp', None),
+            ('bath_temp', None),
+            ('bath_raw', None),
+            ('bath_rate', None),
+            ('heatCapacity', float(config.get(section, 'Heat_Capacity'))),
+            ('mass', float(config.get(section, 'Mass'))),
+            ('emissivity', float(config.get(section, 'Emissivity'))),
+            ('area', float(config.get(section, 'Area'))),
+            ('resistance', float(config.get(section, 'Resistance'))),
+            ('voltage', float(config.get(section, 'Voltage'))),
+            ('p', float(config.get(section, 'P'))),
+            ('i', float(config.get(section, 'I'))),
+            ('d', float(config.get(section, 'D'))),
+            ('target', None),
+            ('start', False),
+            ('data_fresh', False),
+            ]
+
+
+def staged_gains(energy_deficit, dist):
+    """ Gain mode and the divisor applied to the P/I/D settings, the
+        closer the bath is to target the gentler the tuning.
+    """
+    # Adaptive tuning
+    # Below 33% and more than 20Kj, agressive tuning
+    # if energy_deficit >= (dist/3)*2 and energy_deficit >= 20000:
+    #     return 'Agrressive', 100.00
+    # Within 25%, use a more conservative tuning
+    if energy_deficit <= (dist/10):
+        return 'Conservative', 20000.00
+    # Within 25%, use a more conservative tuning
+    elif energy_deficit <= (dist/4):
+        return 'Conservative', 10000.00
+    # Else normal tuning
+    return 'Normal', 1000.00
+
+
+def control_mode(config, section='Tuning'):
+    """ Mode option of a tuning section, staged PID when absent """
+    if config.has_option(section, 'Mode'):
+        return config.get(section, 'Mode').strip().lower()
+    return ControlLoop.STAGED
+
+
+class ControlLoop( object ):
+    """ Acquisition and PID control of one bath.
+
+        state is the bath's SharedState, controller anything with the
+        BathController interface.
+
+        mode 'staged' leaves the whole element time to the staged PID,
+        'feedforward' puts in what the energy model says is missing plus
+        the radiative loss over the next period, with the PID trimming
+        the model's error on top. sensor_lag is the thermistor's time
+        constant, energy sent within it is discounted from the deficit
+        until the reading catches up.
+
+        Every cycle goes to recorder (a Recorder) when given, verbose
+        prints a line per cycle as well. ready, an Event, is set on the
+        first good reading.
+
+        estimator (a Kalman) filters every bath reading on its way into
+        state, bath_temp is then its estimate, bath_raw the reading and
+        bath_rate the heating rate in 'c/s. Each cycle's element time and
+        loss drive it, and the controller's ir_temp, when it has one, is
+        fused as a direct reading. Its estimate is of the bath itself, so
+        sensor_lag is left to it rather than discounted here.
+
+        publish, a callable taking (topic, **fields) such as
+        Publisher.publish, is handed every good reading as 'sample' and
+        every cycle's record as 'cycle'.
+
+        name labels the loop's metrics (see Metrics.py).
+
+        clock (a VirtualClock, say) runs the period, deadlines and PID on
+        simulated time, sleeping on clock.sleep unless sleep is given.
+        A loop against Emulator.py at --speed N needs a clock that fast
+        too (Clock.from_config), or each real time period would only be
+        sent 1/N of the element time it needs.
+    """
+
+    STAGED = 'staged'
+    FEEDFORWARD = 'feedforward'
+
+    def __init__(self, controller, state, period=10.0, idle_period=5.0,
+                 overrun_policy=CycleScheduler.SKIP, clock=None, sleep=None,
+                 verbose=True, mode=STAGED, sensor_lag=20.0, recorder=None,
+                 ready=None, estimator=None, publish=None, name='bath'):
+        if mode not in (self.STAGED, self.FEEDFORWARD):
+            raise ValueError("Unknown control mode {0!r}".format(mode))
+        self.controller = controller
+        self.state = state
+        self.mode = mode
+        self.period = period
+        self.idle_period = idle_period
+        self.verbose = verbose
+        self.recorder = recorder
+        self.ready = ready
+        self.estimator = estimator
+        self.publish = publish
+        self.name = name
+        self._cycle_seconds = CYCLE_SECONDS.labels(bath=name)
+        self._overruns = CYCLE_OVERRUNS.labels(bath=name)
+        self._requested = ELEMENT_REQUESTED.labels(bath=name)
+        self._issued = ELEMENT_ISSUED.labels(bath=name)
+        self._clamped = ELEMENT_CLAMPED.labels(bath=name)
+        self._state_read = STATE_ACCESS_SECONDS.labels(bath=name, op='snapshot')
+        self._state_write = STATE_ACCESS_SECONDS.labels(bath=name, op='update')
+        # A simulation passes its own clock for both PID dt and deadlines
+        if sleep is None:
+            sleep = time.sleep if clock is None else clock.sleep
+        self.sleep = sleep
+        if clock is None:
+            self.scheduler = CycleScheduler(period, overrun_policy)
+            self.now = monotonic
+            clock = time.time
+        else:
+            self.now = clock
+            self.scheduler = CycleScheduler(period, overrun_policy, clock=clock, sleep=sleep)
+        # Initialise PID object
+        self.pid = PID.control(state['p']/10000.0, state['i']/10000.0, state['d']/10000.0,
+                               clock=clock)
+        self.dist = None
+        self.target_reached = False
+        # Net joules sent recently, not yet showing at the thermistor
+        self.in_flight = 0.0
+        if estimator is not None:
+            sensor_lag = 0.0
+        self.sensor_lag = sensor_lag
+        self.unseen = math.exp(-period / sensor_lag) if sensor_lag > 0 else 0.0
+        # Of that, what the reading will still be missing a period on
+        self.lagging = 0.0
+
+    def get_temp(self, send=False, on_time=0):
+        with Trace.span('get_temp', send=send):
+            # Element time and temperatures in one exchange where supported
+            if send: t = self.controller.set_element_and_get_temperatures(on_time)
+            else:    t = self.controller.get_temperatures()
+            # If there is a problem with packet
+            if t is None or t[0] == 0.0 or t[1] == 0.0 or math.isnan(t[1]):
+                self.state['data_fresh'] = False
+                return
+            if self.estimator is None:
+                sample = dict(env_temp=t[0], bath_temp=t[1])
+            else:
+                bath, rate = self.estimator.step(self.now(), t[1],
+                                                 getattr(self.controller, 'ir_temp', None))
+                sample = dict(env_temp=t[0], bath_temp=bath, bath_raw=t[1], bath_rate=rate)
+            with self._state_write.time():
+                self.state.update(sample, data_fresh=True)
+            if self.publish is not None:
+                self.publish('sample', time=self.now(), **sample)
+            if self.ready is not None and not self.ready.is_set():
+                self.ready.set()
+
+    def reset(self):
+        """ Forget the run so far, next cycle measures a new distance """
+        self.dist = None
+        self.target_reached = False
+        self.in_flight = 0.0
+        self.lagging = 0.0
+
+    def lag(self, seconds):
+        """ Fraction of energy put in evenly over the first seconds of
+            a period that the thermistor has yet to show by its end
+        """
+        if self.sensor_lag <= 0:
+            return 0.0
+        if seconds <= 0:
+            return self.unseen
+        tau = self.sensor_lag
+        return tau / seconds * (math.exp(-(self.period - seconds) / tau) - self.unseen)
+
+    def cycle(self):
+        """ One control cycle, element time from the energy deficit """
+        # One consistent read of everything the cycle needs
+        with self._state_read.time():
+            state = self.state.snapshot()
+        To = state['target']
+        Ta = state['env_temp']
+        Tb = state['bath_temp']
+        m  = state['mass']
+        h  = state['heatCapacity']
+        e  = state['emissivity']
+        a  = state['area']
+        w  = resistance_to_watts(state['resistance'], state['voltage'])
+        if Tb >= To: self.target_reached = True
+        with Trace.span('energy_model'):
+            # Calculate desired energy within medium
+            set_point  = temperature_to_joules(To, Ta, m, h)
+            # Add boltzmann radiated loss for that moment
+            #set_point += boltzmann_loss(e, a, To, Ta)
+            # Assess the current energy within medium
+            current_energy = temperature_to_joules(Tb, Ta, m, h)
+            bltz = boltzmann_loss(e,a, Tb, Ta)
+            # Add boltzamn
+            energy_deficit = set_point - current_energy #+ bltz
+        # First loop? save total error for adaptive tuning
+        if self.dist is None: self.dist = energy_deficit
+        record = dict(time=self.now(), env_temp=Ta, bath_temp=Tb, set_point=set_point,
+                      deficit=energy_deficit, control_mode=CONTROL_MODES.index(self.mode),
+                      bath_rate=state['bath_rate'] or 0.0)
+        element_time = 0.0
+        if self.mode == self.FEEDFORWARD:
+            energy_output = self.feedforward(energy_deficit, bltz, state, record)
+        elif energy_deficit > 0:
+            energy_output = self.correction(energy_deficit, state, record)
+        else:
+            energy_output = None
+        if energy_output is not None:
+            # pid returns energy to put in, convert to watt seconds
+            element_time = joules_to_watt_seconds(energy_output, w)
+            self._requested.inc(max(element_time, 0.0))
+            if element_time >= 10.0:
+                element_time = 10.0
+                self._clamped.inc()
+            element_time = max(element_time, 0.0)
+        if energy_output is not None:
+            if element_time > 0.0:
+                self.get_temp(send=True, on_time=int(element_time*1000))
+            self._issued.inc(element_time)
+        if self.estimator is not None:
+            # What the element and the loss will do to the bath this period
+            capacity = temperature_to_joules(1.0, 0.0, m, h)
+            self.estimator.drive(self.now(), w / capacity, element_time, bltz / capacity)
+        record['element_time'] = element_time
+        # Only what outruns the loss goes on to raise the reading. The
+        # next cycle sees a reading from before this period's energy,
+        # the one after a reading missing lag() of it.
+        sent, lost = element_time * w, bltz * self.period
+        self.in_flight = self.lagging + sent - lost
+        self.lagging = (self.lagging * self.unseen + sent * self.lag(element_time)
+                        - lost * self.lag(self.period))
+        if self.recorder is not None:
+            self.recorder.record(**record)
+        if self.publish is not None:
+            self.publish('cycle', **record)
+        if self.verbose:
+            print "{time:10.1f}  bath {bath_temp:6.2f}'c  deficit {deficit:10.0f} J  " \
+                  "element {element_time:6.3f} s".format(**record)
+
+    def correction(self, energy_deficit, state, record):
+        """ Staged PID output for the deficit, in joules """
+        mode, divisor = staged_gains(max(energy_deficit, 0.0), self.dist)
+        self.pid.setKp(state['p'] / divisor)
+        self.pid.setKi(state['i'] / divisor)
+        self.pid.setKd(state['d'] / divisor)
+        # send the PID controller set_energy - stored energy (error)
+        with Trace.span('genOut', divisor=divisor):
+            output = self.pid.genOut(energy_deficit)
+        record.update(divisor=divisor, p_term=self.pid.Cp,
+                      i_term=self.pid.Ki * self.pid.Ci, d_term=self.pid.Kd * self.pid.Cd)
+        return output
+
+    def feedforward(self, energy_deficit, loss, state, record):
+        """ Model energy for the next period plus the PID's trim, in
+            joules. Runs above target too, holding against the loss.
+        """
+        unsent = energy_deficit - self.in_flight
+        model = max(unsent, 0.0) + loss * self.period
+        record['feedforward'] = model
+        # The PID only sees what the model leaves over, not the deficit again
+        return model + self.correction(min(unsent, 0.0), state, record)
+
+    def run(self, alive=lambda: True):
+        """ Poll temperatures, run cycles whilst started, until alive()
+            goes False
+        """
+        while alive():
+            # Kick over
+            self.get_temp()
+            if self.state['start'] and self.state['data_fresh']:
+                self.reset()
+                self.scheduler.start()
+                while self.state['start'] and alive():
+                    if self.scheduler.wait(alive) is None:
+                        break
+                    with self._cycle_seconds.time(), Trace.span('cycle'):
+                        self.cycle()
+                    # Update temps
+                    self.get_temp()
+                    overruns = self.scheduler.overruns
+                    self.scheduler.done()
+                    if self.scheduler.overruns != overruns:
+                        self._overruns.inc()
+            else:
+                self.sleep(self.idle_period)
@@ -0,0 +1,281 @@
+""" Headless bath control with a local socket API.
+
+    Runs the control loop(s) without Qt, so nothing a GUI does (or
+    closing it) touches temperature control, and serves their state over
+    a Unix domain socket. pyBath.py --connect is one client, anything
+    that speaks the protocol is another.
+
+    python Daemon.py config.conf --socket /tmp/pybath.sock
+    python Daemon.py baths.conf
+
+    A config with [Bath <name>] sections runs that rack (see MultiBath.py),
+    otherwise the single bath on [Connection].
+
+    The protocol is a JSON object per line each way:
+
+        {"cmd": "get", "names": ["bath_temp"]}  -> {"ok": true, "state": {...}}
+        {"cmd": "set", "values": {"target": 37.0, "start": true}}
+        {"cmd": "wait", "timeout": 10}         -> {"ok": true, "ready": true}
+        {"cmd": "status"}                      -> {"ok": true, "status": {...}}
+
+    "bath" picks a bath by name, the first by default. Failures come back
+    as {"ok": false, "error": "..."}. Only settings may be set, readings
+    belong to the loop.
+"""
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import logging
+import argparse
+import threading
+import SocketServer
+from ConfigParser import SafeConfigParser
+
+import Clock
+from ControlLoop import tuning_state, control_mode
+from Kalman import Kalman
+import Metrics
+from MultiBath import Bath, BathRuntime
+from PubSub import Publisher
+from Recorder import Recorder
+from Thermistor import Thermistor
+import Trace
+
+log = logging.getLogger('Daemon')
+
+SOCKET = '/tmp/pybath.sock'
+
+READINGS = frozenset(['env_temp', 'bath_temp', 'bath_raw', 'bath_rate', 'data_fresh'])
+
+
+class DaemonError( IOError ):
+    """ The daemon refused a request or could not be reached """
+
+
+def single_bath(config, publisher=None):
+    """ The bath pyBath.py drives, from [Connection] and [Tuning] """
+    stream_period = (config.getint('Connection', 'Stream_Period')
+                     if config.has_option('Connection', 'Stream_Period') else 0)
+    return Bath('bath', config.get('Connection', 'Port'), config.get('Connection', 'Baud'),
+                tuning_state(config), stream_period=stream_period,
+                mode=control_mode(config), recorder=Recorder.from_config(config),
+                thermistor=Thermistor.from_config(config),
+                estimator=Kalman.from_config(config), publisher=publisher,
+                clock=Clock.from_config(config))
+
+
+class _Handler( SocketServer.StreamRequestHandler ):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                reply = self.server.request(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {'ok': False, 'error': str(e)}
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+
+class DaemonServer( SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer ):
+    """ Serves a BathRuntime's baths on a Unix socket, a thread per client """
+
+    daemon_threads = True
+
+    def __init__(self, path, runtime):
+        self.runtime = runtime
+        self.baths = dict((bath.name, bath) for bath in runtime.baths)
+        # A socket left by a daemon that died is in the way
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        SocketServer.UnixStreamServer.__init__(self, path, _Handler)
+
+    def request(self, message):
+        """ Reply to one decoded request """
+        if not isinstance(message, dict):
+            return {'ok': False, 'error': "Requests are JSON objects"}
+        name = message.get('bath')
+        bath = self.runtime.baths[0] if name is None else self.baths[name]
+        cmd = message['cmd']
+        if cmd == 'get':
+            state = bath.state.snapshot()
+            names = message.get('names')
+            if names is not None:
+                state = dict((n, state[n]) for n in names)
+            return {'ok': True, 'state': state}
+        if cmd == 'set':
+            values = message['values']
+            if not isinstance(values, dict):
+                return {'ok': False, 'error': "values is an object of name: value"}
+            refused = [n for n in values if n in READINGS or n not in bath.state]
+            if refused:
+                return {'ok': False, 'error': "Can't set {0}".format(', '.join(sorted(refused)))}
+            bath.state.update(values)
+            return {'ok': True}
+        if cmd == 'wait':
+            return {'ok': True, 'ready': bath.ready.wait(message.get('timeout'))}
+        if cmd == 'status':
+            return {'ok': True, 'status': self.runtime.status()}
+        return {'ok': False, 'error': "Unknown command {0!r}".format(cmd)}
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+class DaemonClient( object ):
+    """ A bath's state in a running daemon, through the same dict
+        interface as SharedState, so MainWindow can use either. Also
+        Event-like, wait() returns once the bath has had a good reading.
+
+        Reconnects on the next call after the daemon goes away, calls in
+        between raise DaemonError.
+    """
+
+    def __init__(self, path=SOCKET, bath=None, timeout=5.0):
+        self.path = path
+        self.bath = bath
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _connect(self, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.path)
+        except socket.error as e:
+            sock.close()
+            raise DaemonError("No daemon on {0}: {1}".format(self.path, e))
+        return sock, sock.makefile('rb')
+
+    @staticmethod
+    def _exchange(sock, replies, message):
+        sock.sendall(json.dumps(message) + '\n')
+        line = replies.readline()
+        if not line:
+            raise DaemonError("Daemon closed the connection")
+        reply = json.loads(line)
+        if not reply['ok']:
+            raise DaemonError(reply['error'])
+        return reply
+
+    def call(self, cmd, **args):
+        """ One request, the reply as a dict """
+        args.update(cmd=cmd)
+        if self.bath is not None:
+            args['bath'] = self.bath
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self.sock = self._connect(self.timeout)
+                return self._exchange(self.sock[0], self.sock[1], args)
+            except (socket.error, DaemonError):
+                self.close()
+                raise
+
+    def close(self):
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            sock[1].close()
+            sock[0].close()
+
+    def __getitem__(self, name):
+        return self.call('get', names=[name])['state'][name]
+
+    def __setitem__(self, name, value):
+        self.update({name: value})
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def get(self, name, default=None):
+        return self.snapshot().get(name, default)
+
+    def keys(self):
+        return self.snapshot().keys()
+
+    def update(self, *args, **kwargs):
+        self.call('set', values=dict(*args, **kwargs))
+
+    def snapshot(self):
+        return self.call('get')['state']
+
+    def status(self):
+        return self.call('status')['status']
+
+    def is_set(self):
+        return self.wait(0)
+
+    def wait(self, timeout=None):
+        """ Block until the bath is ready, over its own connection so
+            other calls carry on. Keeps trying while the daemon is down.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        args = {'cmd': 'wait', 'timeout': timeout}
+        if self.bath is not None:
+            args['bath'] = self.bath
+        while True:
+            try:
+                sock, replies = self._connect(None)
+                try:
+                    return self._exchange(sock, replies, args)['ready']
+                finally:
+                    replies.close()
+                    sock.close()
+            except (socket.error, DaemonError):
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                time.sleep(1.0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config', nargs='?', default='config.conf')
+    parser.add_argument('--socket', default=None,
+                        help="default [Daemon] Socket, else " + SOCKET)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(threadName)s %(message)s')
+
+    config = SafeConfigParser()
+    if not config.read(args.config):
+        sys.exit("Can't read {0}".format(args.config))
+    path = args.socket or (config.get('Daemon', 'Socket')
+                           if config.has_option('Daemon', 'Socket') else SOCKET)
+    # Prometheus scrape endpoint, [Metrics] Port
+    Metrics.serve_from_config(config)
+    # Chrome trace of the loop's stages, [Trace] Path
+    Trace.from_config(config, 'daemon')
+    # Live readings and cycles for any number of monitors, see PubSub.py
+    publisher = Publisher.from_config(config)
+    runtime = BathRuntime.from_config(config, publisher)
+    if not runtime.baths:
+        runtime = BathRuntime([single_bath(config, publisher)])
+    server = DaemonServer(path, runtime)
+    server_thread = threading.Thread(target=server.serve_forever, name='Socket')
+    server_thread.daemon = True
+    server_thread.start()
+    runtime.start()
+    log.info("Serving %s on %s", ', '.join(b.name for b in runtime.baths), path)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    try:
+        while not stopping.is_set():
+            stopping.wait(1.0)
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    runtime.stop()
+    if publisher is not None:
+        publisher.close()
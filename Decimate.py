@@ -0,0 +1,32 @@
+import numpy
+
+
+def lttb(x, y, threshold):
+    """ Largest-Triangle-Three-Buckets downsampling of a series to at most
+        threshold points, keeping its visual shape (peaks and dips survive
+        where plain striding would drop them). First and last points are
+        always kept. Returns (x, y) arrays.
+    """
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+    # Bucket edges for the n - 2 interior points
+    edges = numpy.linspace(1, n - 1, threshold - 1).astype(int)
+    keep = numpy.empty(threshold, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        # Third vertex, the mean of the next bucket (the last point for the last)
+        if i + 2 < len(edges):
+            nxt = slice(edges[i + 1], edges[i + 2])
+            cx, cy = x[nxt].mean(), y[nxt].mean()
+        else:
+            cx, cy = x[-1], y[-1]
+        ax, ay = x[a], y[a]
+        area = numpy.abs((ax - cx) * (y[start:stop] - ay) - (ax - x[start:stop]) * (cy - ay))
+        a = start + int(area.argmax())
+        keep[i + 1] = a
+    return x[keep], y[keep]
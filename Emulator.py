@@ -0,0 +1,316 @@
+""" BathController.ino on a pseudo-terminal.
+
+    Speaks the firmware protocol byte for byte, v1 ENQ/ACK with DC1/DC2/DC3
+    packets, v2 frames, DC4 streaming, ETB raw ADC readings and the IR
+    bath reading after the features byte, NAK plus
+    interlock on anything it doesn't like, in front of a BathPlant instead
+    of real hardware.
+    Point [Connection] Port at the printed device (or --link) and run
+    pyBath.py as usual.
+
+    python Emulator.py --speed 10 --link /tmp/ttyBATH
+
+    --speed runs the plant (and the element on-times it is sent) that many
+    times faster than real time. The host has to run its control period
+    on the same clock or each cycle heats for 1/speed of the time it
+    should, so --speed defaults to [Connection] Speed, which pyBath.py,
+    Daemon.py and MultiBath.py (per [Bath] section) read as well.
+"""
+import os
+import pty
+import tty
+import time
+import select
+import argparse
+import threading
+from ConfigParser import SafeConfigParser
+
+from Clock import VirtualClock, monotonic
+from PacketCodec import (PacketCodec, PKT_SZ, FRAME_MAX_DATA, CRC, ELEMENT_TIME, TEMPERATURES,
+                         IR_TEMPERATURE, STREAM_PERIOD, TELEMETRY_TIME, crc16)
+from Plant import BathPlant
+from Thermistor import Thermistor
+
+READY_REQUEST        = 0x05 # ENQ
+SUCCESS_ACCEPT       = 0x06 # ACK
+FAIL_DENY            = 0x15 # NAK
+EMERGENCY_STOP       = 0x18 # CAN
+FRAME_START          = 0x02 # STX
+TEMPERATURE_REQUEST  = 0x11 # DC1
+SET_ELEMENT_REQUEST  = 0x12 # DC2
+ELEMENT_TEMP_REQUEST = 0x13 # DC3
+STREAM_REQUEST       = 0x14 # DC4
+RAW_ADC_REQUEST      = 0x17 # ETB
+TELEMETRY_FRAME      = 0x16 # SYN
+
+FEATURE_ELEMENT_TEMP = 0x01
+FEATURE_V2           = 0x02
+FEATURE_STREAM       = 0x04
+FEATURE_RAW_ADC      = 0x08
+FEATURE_RAW_ACTIVE   = 0x10
+FEATURE_IR           = 0x20
+ALL_FEATURES = (FEATURE_ELEMENT_TEMP | FEATURE_V2 | FEATURE_STREAM | FEATURE_RAW_ADC
+                | FEATURE_IR)
+RAW_MAX_SAMPLES = 64
+
+
+class _Timeout(Exception):
+    pass
+
+
+class FirmwareEmulator( object ):
+    """ features - what to advertise and accept, 0 behaves like the
+                   original v1 firmware
+        thermistor - curve the raw ADC mode readings are made from
+    """
+
+    def __init__(self, plant, features=ALL_FEATURES, timeout=5.0, thermistor=None):
+        self.plant = plant
+        self.features = features
+        self.codec = PacketCodec()
+        self.thermistor = thermistor or Thermistor(RAW_MAX_SAMPLES)
+        self.raw_samples = 0
+        self.timeout = timeout
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        # Keep our slave fd so the pty survives the host reopening it
+        self.port = os.ttyname(self.slave)
+        self.interlocked = False
+        self.stream_period = 0
+        self.last_push = 0
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def millis(self):
+        return int(self.plant.clock() * 1000) & 0xFFFFFFFF
+
+    def _poll_timeout(self):
+        """ Real seconds until the next telemetry push is due """
+        if not self.stream_period:
+            return 0.5
+        due = (self.last_push + self.stream_period - self.plant.clock() * 1000) / 1000.0
+        speed = getattr(self.plant.clock, 'speed', None) or 1.0
+        return max(0.0, min(0.5, due / speed))
+
+    def serve_forever(self):
+        poller = select.poll()
+        poller.register(self.master, select.POLLIN)
+        while self.running:
+            ready = poller.poll(self._poll_timeout() * 1000)
+            if self.interlocked:
+                # Like interlock(), NAK every 500 ms until reset
+                self._drain()
+                self._write(chr(FAIL_DENY))
+                time.sleep(0.5)
+                continue
+            if ready:
+                try:
+                    self._handle(ord(self._read(1)))
+                except _Timeout:
+                    pass
+            self._push()
+
+    def _drain(self):
+        while select.select([self.master], [], [], 0)[0]:
+            os.read(self.master, 1024)
+
+    def _read(self, n):
+        data = b""
+        deadline = monotonic() + self.timeout
+        while len(data) < n:
+            if not select.select([self.master], [], [], max(0, deadline - monotonic()))[0]:
+                raise _Timeout()
+            data += os.read(self.master, n - len(data))
+        return data
+
+    def _write(self, data):
+        while data:
+            data = data[os.write(self.master, data):]
+
+    def _interlock(self):
+        self.plant.set_element(0)
+        self.stream_period = 0
+        self.raw_samples = 0
+        self.interlocked = True
+
+    def reset(self):
+        """ Power cycle out of an interlock """
+        self.interlocked = False
+        self.stream_period = 0
+        self.raw_samples = 0
+        self.plant.set_element(0)
+
+    def _temps(self):
+        env, bath = self.plant.temperatures()
+        return int(env * 100) & 0xFFFF, int(bath * 100) & 0xFFFF
+
+    def _frame_temps(self):
+        """ Env, bath and features of a v2 reply, bath as the sum of
+            raw_samples ADC readings when in raw mode
+        """
+        env, bath = self._temps()
+        if not self.raw_samples:
+            return env, bath, self.features
+        counts = self.thermistor.counts(self.plant.temperatures()[1])
+        # The curve is per reading, scale to the samples asked for
+        counts = int(round(counts * self.raw_samples / float(self.thermistor.samples)))
+        return env, counts & 0xFFFF, self.features | FEATURE_RAW_ACTIVE
+
+    def _ir(self):
+        """ IR field, 0 like the firmware's before its first reading """
+        ir = self.plant.ir_temperature()
+        return 0 if ir is None else int(ir * 100) & 0xFFFF
+
+    def _frame_data(self):
+        """ Temperature data of a v2 reply or telemetry frame """
+        data = TEMPERATURES.pack(*self._frame_temps())
+        if self.features & FEATURE_IR:
+            data += IR_TEMPERATURE.pack(self._ir())
+        return data
+
+    # v1, ENQ/ACK handshake and 64 byte packets
+
+    def _handle(self, b):
+        if b == READY_REQUEST:
+            self._write(chr(SUCCESS_ACCEPT))
+            b = ord(self._read(1))
+            if b == TEMPERATURE_REQUEST:
+                self._write(chr(SUCCESS_ACCEPT))
+                self._send_temps()
+            elif b == SET_ELEMENT_REQUEST:
+                self._write(chr(SUCCESS_ACCEPT))
+                self._receive_element_time()
+            elif b == ELEMENT_TEMP_REQUEST and self.features & FEATURE_ELEMENT_TEMP:
+                self._write(chr(SUCCESS_ACCEPT))
+                if self._receive_element_time():
+                    self._send_temps()
+            else:
+                self._write(chr(FAIL_DENY))
+                self._interlock()
+        elif b == FRAME_START and self.features & FEATURE_V2:
+            self._receive_frame()
+        else:
+            self._write(chr(FAIL_DENY))
+            self._interlock()
+
+    def _send_temps(self):
+        e, b = self._temps()
+        ir = self._ir() if self.features & FEATURE_IR else 0
+        self._write(self.codec.encode_temperatures(e, b, self.features, ir))
+        if ord(self._read(1)) != SUCCESS_ACCEPT:
+            self._interlock()
+
+    def _receive_element_time(self):
+        on_time = self.codec.decode_element(self._read(PKT_SZ))
+        if on_time is None:
+            self._write(chr(FAIL_DENY))
+            self._interlock()
+            return False
+        self._write(chr(SUCCESS_ACCEPT))
+        self.plant.set_element(on_time)
+        return True
+
+    # v2, STX length command data CRC-16
+
+    def _receive_frame(self):
+        length = ord(self._read(1))
+        if length == 0 or length > FRAME_MAX_DATA + 1:
+            self._send_frame(FAIL_DENY)
+            self._interlock()
+            return
+        frame = self._read(length)
+        sent = CRC.unpack(self._read(2))[0]
+        if crc16(chr(length) + frame) != sent:
+            self._send_frame(FAIL_DENY)
+            self._interlock()
+            return
+        command, data = ord(frame[0]), frame[1:]
+        element = command in (SET_ELEMENT_REQUEST, ELEMENT_TEMP_REQUEST) and len(data) == 4
+        if element:
+            self.plant.set_element(ELEMENT_TIME.unpack(data)[0])
+        if command == TEMPERATURE_REQUEST or (command == ELEMENT_TEMP_REQUEST and element):
+            self._send_frame(SUCCESS_ACCEPT, self._frame_data())
+        elif command == SET_ELEMENT_REQUEST and element:
+            self._send_frame(SUCCESS_ACCEPT)
+        elif command == STREAM_REQUEST and len(data) == 2 and self.features & FEATURE_STREAM:
+            self.stream_period = STREAM_PERIOD.unpack(data)[0]
+            self.last_push = self.millis()
+            self._send_frame(SUCCESS_ACCEPT)
+        elif (command == RAW_ADC_REQUEST and len(data) == 1 and self.features & FEATURE_RAW_ADC
+                and ord(data) <= RAW_MAX_SAMPLES):
+            self.raw_samples = ord(data)
+            self._send_frame(SUCCESS_ACCEPT)
+        else:
+            self._send_frame(FAIL_DENY)
+
+    def _send_frame(self, status, data=b""):
+        self._write(self.codec.encode_frame(status, data))
+
+    def _push(self):
+        if not self.stream_period:
+            return
+        now = self.millis()
+        if now - self.last_push < self.stream_period:
+            return
+        self.last_push += self.stream_period
+        # Fell behind, don't try and catch up with a burst
+        if now - self.last_push >= self.stream_period:
+            self.last_push = now
+        self._send_frame(TELEMETRY_FRAME, TELEMETRY_TIME.pack(now) + self._frame_data())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='config.conf')
+    parser.add_argument('--speed', type=float, default=None,
+                        help="simulated seconds per real second, default [Connection] Speed")
+    parser.add_argument('--features', type=int, default=ALL_FEATURES,
+                        help="advertised feature bits, 0 for v1 firmware")
+    parser.add_argument('--env-temp', type=float, default=21.0)
+    parser.add_argument('--bath-temp', type=float, default=None)
+    parser.add_argument('--noise', type=float, default=0.0,
+                        help="thermistor noise, standard deviation in degrees")
+    parser.add_argument('--ir-noise', type=float, default=0.2,
+                        help="IR sensor noise, standard deviation in degrees")
+    parser.add_argument('--link', help="symlink to the pty, for [Connection] Port")
+    args = parser.parse_args()
+
+    config = SafeConfigParser()
+    config.read(args.config)
+    if args.speed is None:
+        args.speed = (config.getfloat('Connection', 'Speed')
+                      if config.has_option('Connection', 'Speed') else 1.0)
+    plant = BathPlant.from_config(config, VirtualClock(args.speed),
+                                  env_temp=args.env_temp, bath_temp=args.bath_temp,
+                                  noise=args.noise, ir_noise=args.ir_noise)
+    emulator = FirmwareEmulator(plant, features=args.features,
+                                thermistor=Thermistor.from_config(config))
+    port = emulator.start()
+    if args.link:
+        if os.path.lexists(args.link):
+            os.unlink(args.link)
+        os.symlink(port, args.link)
+        port = args.link
+    print "Emulating BathController on {0} at {1}x".format(port, args.speed)
+    try:
+        while True:
+            time.sleep(10)
+            print "Bath {0:.2f}'c, element {1}, {2:.0f} J used".format(
+                  plant.bath_temp, 'ON' if plant.element_on else 'off', plant.energy_used)
+    except KeyboardInterrupt:
+        pass
@@ -1,4 +1,5 @@
 #include <DHT.h>
+#include <util/crc16.h>
 #include "IRTemp.h"
 
 #define HV_PIN 13
@@ -15,15 +16,41 @@
 
 #define TEMPERATURE_REQUEST 0x11      // DC1
 #define SET_ELEMENT_REQUEST 0x12      // DC2
+#define ELEMENT_TEMP_REQUEST 0x13     // DC3 - set element, reply temps
+#define STREAM_REQUEST      0x14      // DC4 - v2 only, push period in ms
+#define RAW_ADC_REQUEST     0x17      // ETB - v2 only, raw bath readings
+#define TELEMETRY_FRAME     0x16      // SYN - status byte of pushed frames
 #define SUCCESS_ACCEPT      0x06      // ACK
 #define READY_REQUEST       0x05      // ENQ
 #define FAIL_DENY           0x15      // NAK
 #define EMERGENCY_STOP      0x18      // CAN
+#define FRAME_START         0x02      // STX - protocol v2 frame
 #define TEMPERATURE_SCALE    100      // Scale to int
 
 #define PKT_SZ               64
 #define PKT_BUFFER_SZ       128      
 
+// Advertised to the host in byte 4 of every temperature packet,
+// old firmware leaves the padding zeroed
+#define PKT_FEATURES          4
+#define FEATURE_ELEMENT_TEMP 0x01
+#define FEATURE_V2           0x02
+#define FEATURE_STREAM       0x04
+#define FEATURE_RAW_ADC      0x08
+#define FEATURE_RAW_ACTIVE   0x10     // bath field is raw ADC counts
+#define FEATURE_IR           0x20     // IR bath reading follows the features byte
+#define FEATURES (FEATURE_ELEMENT_TEMP | FEATURE_V2 | FEATURE_STREAM | FEATURE_RAW_ADC | FEATURE_IR)
+#define PKT_IR                5
+#define FRAME_TEMPS_SZ        7      // env, bath, features, IR
+
+// Raw mode - the bath field is the sum of the last raw_samples readings,
+// taken back to back in loop(), the host converts them
+#define RAW_MAX_SAMPLES       64
+
+// v2 frame - STX, length, command/status, data, CRC-16 (big endian)
+// length counts the command byte and data, CRC covers length onwards
+#define FRAME_MAX_DATA        16
+
 // Saftey interlocks
 static const boolean interlocks = true;
 boolean interlock_triggered = false;
@@ -38,8 +65,18 @@ boolean sending = false;
 boolean element_on = false;
 unsigned long off_time = 0;
 unsigned long last_sample = 0;
+// Telemetry push, 0 = off
+uint16_t stream_period = 0;
+unsigned long last_push = 0;
+// Raw ADC mode, 0 = off
+uint8_t raw_samples = 0;
+uint16_t raw_ring[RAW_MAX_SAMPLES];
+uint8_t raw_head = 0;
+uint16_t raw_sum = 0;
 
 volatile float fusion_bath_temp = 0;
+// Last IR reading, 0 until there is a good one, sent for the host to fuse
+volatile float ir_bath_temp = 0;
 volatile float last_temp = 0;
 volatile uint8_t timer1_counter;
 volatile uint8_t count;
@@ -79,63 +116,24 @@ void loop() {
       b = Serial.read();
       if(b == TEMPERATURE_REQUEST){
         Serial.write(SUCCESS_ACCEPT);
-        uint8_t pkt[PKT_BUFFER_SZ] = "";
-        pack_temps(pkt, env_temp.readTemperature(), sample_bath_temp());
-        for(int i = 0; i < PKT_SZ; i++){
-          Serial.write(pkt[i]);
-        }
-        while(Serial.available() <= 0);
-        b = Serial.read();
-        // If the packet was corrupt
-        if(b != SUCCESS_ACCEPT){
-          // Assume the worst, shut off
-          digitalWrite(HV_PIN, LOW);
-          interlock();
-        }
+        send_temps();
         clear_comms();
       }
       else if(b == SET_ELEMENT_REQUEST){
         // Acknowledge request
         Serial.write(SUCCESS_ACCEPT);
-        // Annoying arduino bug (<= 1.6.5),compiler wants this to
-        // be uint32_t here, can't use uint8_t and recast @ bitwise
-        uint32_t bugfix[5];
-        // Normal packet..
-        uint8_t pkt[PKT_BUFFER_SZ];
-        while(Serial.available() < (PKT_SZ - 1));
-        // Get out the element time
-        for(int i = 0; i < 4; i++){ 
-          bugfix[i] = Serial.read();
-          // Copy over as 8bit.. :/
-          pkt[i] = (uint8_t)bugfix[i];
-        }
-        // Get the rest of the packet data
-        for(int i = 4; i < PKT_SZ; i++){ 
-          pkt[i] = Serial.read();
-        }
-        // Assemble element time
-        uint32_t total = (uint32_t)(bugfix[0] << 24)|
-                         (uint32_t)(bugfix[1] << 16)|
-                         (uint32_t)(bugfix[2] <<  8)|
-                         (uint32_t)(bugfix[3]);
-        // Extract checksum
-        uint8_t csum = pkt[PKT_SZ - 1];
-        if(csum == checksum(pkt)){
-          // Acknowledge reciept
-          Serial.write(SUCCESS_ACCEPT);
-          digitalWrite(HV_PIN, HIGH);  
-          element_on = true;
-          off_time = millis() + total;
-        } else {
-          // Announce failure
-          Serial.write(FAIL_DENY);
-          digitalWrite(HV_PIN, LOW);
-          interlock_triggered = true;
-          interlock();
-        }
+        receive_element_time();
         // Cleanup
         clear_comms();
       }
+      else if(b == ELEMENT_TEMP_REQUEST){
+        // Element packet in, temperature packet straight back out,
+        // saves the host a second ENQ/DC1 handshake per cycle
+        Serial.write(SUCCESS_ACCEPT);
+        receive_element_time();
+        send_temps();
+        clear_comms();
+      }
       // Wasn't a known request, bump it
       else {
         clear_comms();
@@ -143,6 +141,12 @@ void loop() {
         interlock_triggered = true;
         interlock();
       }
+    }
+    // Protocol v2, whole request in one frame
+    else if(b == FRAME_START){
+      sending = true;
+      receive_frame();
+      clear_comms();
     // Wasn't ready req, bump it
     } else {
       clear_comms();
@@ -155,6 +159,16 @@ void loop() {
     digitalWrite(HV_PIN, LOW);
     element_on = false;
   }
+  if(stream_period && (millis() - last_push >= stream_period)){
+    sending = true;
+    last_push += stream_period;
+    // Fell behind, don't try and catch up with a burst
+    if(millis() - last_push >= stream_period) last_push = millis();
+    send_telemetry();
+  }
+  if(raw_samples){
+    sample_raw();
+  }
   Serial.flush();
   sending = false;
 }
@@ -169,13 +183,18 @@ ISR(TIMER1_OVF_vect)        // interrupt service routine
   sei();
   count++;
   if(count >= 2){
-    uint16_t dt = last_sample - millis();
-    last_sample = millis();
     TCNT1 = timer1_counter;   // preload timer
+    // The IR sensor isn't on the ADC, it keeps reading in raw mode
     float r = ir_temp.getIRTemperature(IR_UNIT);
     if(isnan(r)){r = 0;}
-    float t_delta = ((r - last_temp) / dt);
-    fusion_bath_temp = temperature_fusion(t_delta, sample_bath_temp(), float(dt/1000), fusion_bath_temp);
+    ir_bath_temp = r;
+    // Raw mode has the ADC to itself in loop()
+    if(!raw_samples){
+      uint16_t dt = last_sample - millis();
+      last_sample = millis();
+      float t_delta = ((r - last_temp) / dt);
+      fusion_bath_temp = temperature_fusion(t_delta, sample_bath_temp(), float(dt/1000), fusion_bath_temp);
+    }
     count = 0;
   }
   // Just incase
@@ -227,6 +246,187 @@ float temperature_fusion(float integral_temp, float noisey_temp,
   return (0.99)*(fusion_temp+(integral_temp*dt))+(0.01)*(noisey_temp);
 }
 
+void send_temps(){
+  // Temperature packet out, wait for the host to ACK it
+  uint8_t pkt[PKT_BUFFER_SZ] = "";
+  pack_temps(pkt, env_temp.readTemperature(), sample_bath_temp());
+  for(int i = 0; i < PKT_SZ; i++){
+    Serial.write(pkt[i]);
+  }
+  while(Serial.available() <= 0);
+  uint8_t b = Serial.read();
+  // If the packet was corrupt
+  if(b != SUCCESS_ACCEPT){
+    // Assume the worst, shut off
+    digitalWrite(HV_PIN, LOW);
+    interlock();
+  }
+}
+
+void receive_element_time(){
+  // Annoying arduino bug (<= 1.6.5),compiler wants this to
+  // be uint32_t here, can't use uint8_t and recast @ bitwise
+  uint32_t bugfix[5];
+  // Normal packet..
+  uint8_t pkt[PKT_BUFFER_SZ];
+  // The rx ring only holds PKT_SZ - 1, take bytes as they land
+  for(int i = 0; i < PKT_SZ; i++){
+    while(Serial.available() <= 0);
+    pkt[i] = Serial.read();
+  }
+  // Get out the element time
+  for(int i = 0; i < 4; i++){
+    bugfix[i] = pkt[i];
+  }
+  // Assemble element time
+  uint32_t total = (uint32_t)(bugfix[0] << 24)|
+                   (uint32_t)(bugfix[1] << 16)|
+                   (uint32_t)(bugfix[2] <<  8)|
+                   (uint32_t)(bugfix[3]);
+  // Extract checksum
+  uint8_t csum = pkt[PKT_SZ - 1];
+  if(csum == checksum(pkt)){
+    // Acknowledge reciept
+    Serial.write(SUCCESS_ACCEPT);
+    digitalWrite(HV_PIN, HIGH);  
+    element_on = true;
+    off_time = millis() + total;
+  } else {
+    // Announce failure
+    Serial.write(FAIL_DENY);
+    digitalWrite(HV_PIN, LOW);
+    interlock_triggered = true;
+    interlock();
+  }
+}
+
+uint8_t read_blocking(){
+  while(Serial.available() <= 0);
+  return Serial.read();
+}
+
+uint16_t crc16(uint16_t crc, uint8_t b){
+  // CRC-16/CCITT-FALSE when seeded with 0xFFFF
+  return _crc_xmodem_update(crc, b);
+}
+
+void receive_frame(){
+  uint8_t frame[FRAME_MAX_DATA + 2];
+  uint8_t len = read_blocking();
+  if(len == 0 || len > FRAME_MAX_DATA + 1){
+    // Can't trust anything after a bad length
+    send_frame(FAIL_DENY, NULL, 0);
+    digitalWrite(HV_PIN, LOW);
+    interlock_triggered = true;
+    interlock();
+  }
+  uint16_t crc = crc16(0xFFFF, len);
+  for(int i = 0; i < len; i++){
+    frame[i] = read_blocking();
+    crc = crc16(crc, frame[i]);
+  }
+  uint16_t sent = (uint16_t)read_blocking() << 8;
+  sent |= read_blocking();
+  uint8_t command = frame[0];
+  if(crc != sent){
+    // Corrupt request, same treatment as a bad v1 checksum
+    send_frame(FAIL_DENY, NULL, 0);
+    digitalWrite(HV_PIN, LOW);
+    interlock_triggered = true;
+    interlock();
+  }
+  if((command == SET_ELEMENT_REQUEST || command == ELEMENT_TEMP_REQUEST) && len == 5){
+    uint32_t total = ((uint32_t)frame[1] << 24)|
+                     ((uint32_t)frame[2] << 16)|
+                     ((uint32_t)frame[3] <<  8)|
+                     ((uint32_t)frame[4]);
+    digitalWrite(HV_PIN, HIGH);
+    element_on = true;
+    off_time = millis() + total;
+  }
+  if(command == TEMPERATURE_REQUEST || (command == ELEMENT_TEMP_REQUEST && len == 5)){
+    uint8_t temps[FRAME_TEMPS_SZ];
+    pack_frame_temps(temps, env_temp.readTemperature());
+    send_frame(SUCCESS_ACCEPT, temps, FRAME_TEMPS_SZ);
+  }
+  else if(command == SET_ELEMENT_REQUEST && len == 5){
+    send_frame(SUCCESS_ACCEPT, NULL, 0);
+  }
+  else if(command == RAW_ADC_REQUEST && len == 2 && frame[1] <= RAW_MAX_SAMPLES){
+    start_raw(frame[1]);
+    send_frame(SUCCESS_ACCEPT, NULL, 0);
+  }
+  else if(command == STREAM_REQUEST && len == 3){
+    stream_period = ((uint16_t)frame[1] << 8) | frame[2];
+    last_push = millis();
+    send_frame(SUCCESS_ACCEPT, NULL, 0);
+  }
+  else {
+    send_frame(FAIL_DENY, NULL, 0);
+  }
+}
+
+void send_frame(uint8_t status, uint8_t* data, uint8_t len){
+  uint8_t frame[FRAME_MAX_DATA + 4];
+  frame[0] = FRAME_START;
+  frame[1] = len + 1;
+  frame[2] = status;
+  uint16_t crc = crc16(crc16(0xFFFF, frame[1]), status);
+  for(int i = 0; i < len; i++){
+    frame[3 + i] = data[i];
+    crc = crc16(crc, data[i]);
+  }
+  frame[3 + len] = (crc >> 8) & 0xFF;
+  frame[4 + len] = crc & 0xFF;
+  Serial.write(frame, len + 5);
+}
+
+void send_telemetry(){
+  // millis() timestamp then the temperatures, host decodes into a ring
+  uint8_t data[4 + FRAME_TEMPS_SZ];
+  uint32_t now = millis();
+  data[0] = (now >> 24) & 0xFF;
+  data[1] = (now >> 16) & 0xFF;
+  data[2] = (now >>  8) & 0xFF;
+  data[3] = now & 0xFF;
+  pack_frame_temps(data + 4, env_temp.readTemperature());
+  send_frame(TELEMETRY_FRAME, data, 4 + FRAME_TEMPS_SZ);
+}
+
+void pack_frame_temps(uint8_t* data, float env_temp){
+  // Bath as raw counts in raw mode, no conversion or delays here
+  uint16_t e = env_temp  * TEMPERATURE_SCALE;
+  uint16_t b = raw_samples ? raw_sum : sample_bath_temp() * TEMPERATURE_SCALE;
+  data[0] = (e >> 8) & 0xFF;
+  data[1] = e & 0xFF;
+  data[2] = (b >> 8) & 0xFF;
+  data[3] = b & 0xFF;
+  data[4] = FEATURES | (raw_samples ? FEATURE_RAW_ACTIVE : 0);
+  uint16_t i = ir_bath_temp * TEMPERATURE_SCALE;
+  data[5] = (i >> 8) & 0xFF;
+  data[6] = i & 0xFF;
+}
+
+void start_raw(uint8_t samples){
+  // Prime the ring so the first sum is already whole
+  raw_samples = 0;
+  raw_sum = 0;
+  raw_head = 0;
+  for(int i = 0; i < samples; i++){
+    raw_ring[i] = analogRead(BATH_TEMP_PIN);
+    raw_sum += raw_ring[i];
+  }
+  raw_samples = samples;
+}
+
+void sample_raw(){
+  // One reading per pass of loop(), the sum slides along
+  uint16_t v = analogRead(BATH_TEMP_PIN);
+  raw_sum += v - raw_ring[raw_head];
+  raw_ring[raw_head] = v;
+  raw_head = (raw_head + 1) % raw_samples;
+}
+
 void clear_comms(){
   while(Serial.available() > 0){
     Serial.read();
@@ -241,6 +441,10 @@ void pack_temps(uint8_t* packet, float env_temp, float bath_temp){
   packet[1]  = e & 0xFF;
   packet[2]  = (b >> 8) & 0xFF;
   packet[3]  = b & 0xFF;
+  packet[PKT_FEATURES] = FEATURES;
+  uint16_t i = ir_bath_temp * TEMPERATURE_SCALE;
+  packet[PKT_IR]     = (i >> 8) & 0xFF;
+  packet[PKT_IR + 1] = i & 0xFF;
   packet[63] = checksum(packet);
 }
 
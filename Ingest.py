@@ -0,0 +1,156 @@
+""" Legacy logs and analysis CSVs as cached NumPy arrays.
+
+    Sources are read in chunks rather than line by line and converted to
+    typed arrays, which are cached next to the source as
+
+        <source>.<mtime>-<size>.npy
+
+    so an untouched file loads as a memory map straight from the cache,
+    and editing it (or replacing it) makes the old cache stale.
+
+    CSV files (analysis/*.csv) become a 2-D float array, a row per line.
+    Old control loop output (longtest_*.txt, the print based logging with
+    CR, LF or no line endings at all) becomes a LONGTEST record per
+    element time it printed.
+
+    python Ingest.py analysis/*.csv longtest_*.txt
+"""
+import os
+import re
+import sys
+
+import numpy
+
+LONGTEST = numpy.dtype([('element_time', '<f8'), ('clamped', '?')])
+
+CHUNK = 1024 * 1024
+
+_element_time = re.compile(r'Element time\s*=\s*([-+0-9.eE]+)\s*(\[CLAMPED\])?')
+_line = re.compile(r'[^\r\n]*[^\r\n\s][^\r\n]*')
+
+
+def _chunks(path, size=CHUNK):
+    """ Text of path in pieces that end on a line break (CR or LF), the
+        last piece whatever is left
+    """
+    tail = ''
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(size)
+            if not block:
+                break
+            block = tail + block
+            cut = max(block.rfind('\n'), block.rfind('\r')) + 1
+            tail = block[cut:]
+            if cut:
+                yield block[:cut]
+    if tail:
+        yield tail
+
+
+def _parse_lines(text, columns):
+    """ Slow path, rows of text that parse into columns floats """
+    rows = []
+    for line in text.replace('\r', '\n').split('\n'):
+        try:
+            row = [float(x) for x in line.split(',')]
+        except ValueError:
+            continue
+        if len(row) == columns:
+            rows.append(row)
+    return numpy.array(rows, dtype=float).reshape(-1, columns)
+
+
+def parse_csv(path, chunk=CHUNK):
+    """ Numeric CSV as an (n, columns) float array. Headers and rows of the
+        wrong width are skipped.
+    """
+    columns = None
+    blocks = []
+    for text in _chunks(path, chunk):
+        if columns is None:
+            for line in text.replace('\r', '\n').split('\n'):
+                try:
+                    columns = len([float(x) for x in line.split(',')])
+                    break
+                except ValueError:
+                    continue
+            if columns is None:
+                continue
+        try:
+            values = numpy.array(text.replace(',', ' ').split(), dtype=float)
+            # Every line at the expected width, else go slow
+            lines = len(_line.findall(text))
+            if values.size != lines * columns or text.count(',') != lines * (columns - 1):
+                raise ValueError
+            blocks.append(values.reshape(-1, columns))
+        except ValueError:
+            blocks.append(_parse_lines(text, columns))
+    if not blocks:
+        return numpy.zeros((0, columns or 0))
+    return numpy.concatenate(blocks)
+
+
+def parse_longtest(path, chunk=CHUNK):
+    """ Element times printed by the old control loop, as LONGTEST records """
+    times, clamped = [], []
+    tail = ''
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(chunk)
+            text = tail + block
+            # Hold back the last entry, it may run on into the next block
+            cut = text.rfind('Element time') if block else len(text)
+            if cut <= 0:
+                if len(text) < 2 * chunk:
+                    tail = text
+                    continue
+                # No entries in sight, just keep enough for a split marker
+                cut = len(text) - 64
+            for m in _element_time.finditer(text, 0, cut):
+                times.append(float(m.group(1)))
+                clamped.append(m.group(2) is not None)
+            if not block:
+                break
+            tail = text[cut:]
+    records = numpy.zeros(len(times), LONGTEST)
+    records['element_time'] = times
+    records['clamped'] = clamped
+    return records
+
+
+PARSERS = {'.csv': parse_csv, '.txt': parse_longtest}
+
+
+def cache_path(path):
+    st = os.stat(path)
+    return '{0}.{1}-{2}.npy'.format(path, int(st.st_mtime * 1000), st.st_size)
+
+
+def load(path, mmap_mode='r', parser=None):
+    """ Typed array of a source file, from its cache when up to date.
+        parser defaults by extension, see PARSERS.
+    """
+    if parser is None:
+        parser = PARSERS[os.path.splitext(path)[1].lower()]
+    cache = cache_path(path)
+    if os.path.exists(cache):
+        return numpy.load(cache, mmap_mode=mmap_mode)
+    data = parser(path)
+    # Drop caches of earlier versions of the source
+    folder, name = os.path.split(path)
+    stale = re.compile(re.escape(name) + r'\.\d+-\d+\.npy$')
+    for other in os.listdir(folder or '.'):
+        if stale.match(other):
+            os.remove(os.path.join(folder, other))
+    partial = cache + '.tmp'
+    with open(partial, 'wb') as f:
+        numpy.save(f, data)
+    os.rename(partial, cache)
+    return numpy.load(cache, mmap_mode=mmap_mode)
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        data = load(path)
+        print "{0}: {1} {2}".format(path, data.shape, data.dtype)
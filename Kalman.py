@@ -0,0 +1,139 @@
+""" Online estimate of bath temperature and heating rate.
+
+    A three state Kalman filter, [bath, thermistor, rate], over the same
+    thermal model the control loop uses. The element's heat and the loss
+    to the room are known inputs (drive()), so the estimate moves with a
+    pulse instead of waiting for the readings to catch up, and rate is
+    only what that model doesn't explain. The thermistor follows the bath
+    through a first order lag (sensor_lag seconds). A second, direct
+    reading of the bath such as the IR sensor is fused when the firmware
+    sends one. Each step predicts forward by the time since the last one
+    then does one scalar update per reading, all 3x3, O(1) per sample.
+"""
+import math
+
+import numpy
+
+BATH, SENSOR, RATE = 0, 1, 2
+
+
+class Kalman( object ):
+    """ measurement_noise - standard deviation of a thermistor reading, 'c
+        process_noise - how quickly the unmodelled rate may wander, 'c/s^2
+        sensor_lag - thermistor time constant in seconds, 0 for none
+        direct_noise - standard deviation of a direct (IR) reading, 'c
+    """
+
+    def __init__(self, measurement_noise=0.05, process_noise=0.001, sensor_lag=20.0,
+                 direct_noise=0.2):
+        self.measurement_variance = measurement_noise ** 2
+        self.process_variance = process_noise ** 2
+        self.sensor_lag = sensor_lag
+        self.direct_variance = direct_noise ** 2
+        self.reset()
+
+    @classmethod
+    def from_config(cls, config, section='Filter'):
+        """ Filter for the section, None when missing or not Enabled """
+        if not config.has_section(section):
+            return None
+        if config.has_option(section, 'Enabled') and not config.getboolean(section, 'Enabled'):
+            return None
+        get = lambda option, default: (config.getfloat(section, option)
+                                       if config.has_option(section, option) else default)
+        return cls(get('Measurement_Noise', 0.05), get('Process_Noise', 0.001),
+                   get('Sensor_Lag', 20.0), get('Direct_Noise', 0.2))
+
+    def reset(self):
+        self.time = None
+        self.x = numpy.zeros(3)
+        self.p = numpy.zeros((3, 3))
+        # Known input, 'c/s: heating from on_from to on_until, cooling throughout
+        self.heating = self.cooling = 0.0
+        self.on_from = self.on_until = 0.0
+
+    @property
+    def temperature(self):
+        return None if self.time is None else float(self.x[BATH])
+
+    @property
+    def rate(self):
+        """ Heating rate now, 'c/s, the known input plus the unmodelled rest """
+        if self.time is None:
+            return 0.0
+        heating = self.heating if self.on_from <= self.time < self.on_until else 0.0
+        return float(self.x[RATE]) + heating - self.cooling
+
+    def drive(self, now, heating, seconds, cooling=0.0):
+        """ The input until the next drive(): the element adds heating
+            'c/s for seconds from now, the loss takes cooling 'c/s
+        """
+        if self.time is not None:
+            self.predict(now)
+        self.heating, self.cooling = heating, cooling
+        self.on_from, self.on_until = now, now + seconds
+
+    def _propagate(self, h, u):
+        """ Move the state on h seconds with the input a constant u 'c/s """
+        tau = self.sensor_lag
+        a = math.exp(-h / tau) if tau > 0 else 0.0
+        # The thermistor's exact response to a bath ramping at rate + u
+        ramp = h - tau * (1 - a)
+        f = numpy.array([[1.0,   0.0, h],
+                         [1 - a, a,   ramp],
+                         [0.0,   0.0, 1.0]])
+        self.x = f.dot(self.x) + u * numpy.array([h, ramp, 0.0])
+        # Noise on the rate, integrated at the midpoint
+        mid = 0.5 * h
+        lagged = mid - tau * (1 - math.exp(-mid / tau)) if tau > 0 else mid
+        g = numpy.array([mid, lagged, 1.0])
+        self.p = f.dot(self.p).dot(f.T) + self.process_variance * h * numpy.outer(g, g)
+
+    def predict(self, now):
+        """ Up to now, split where the element switches on or off """
+        if now <= self.time:
+            return
+        edges = sorted(set([self.time, now] + [t for t in (self.on_from, self.on_until)
+                                               if self.time < t < now]))
+        for start, end in zip(edges, edges[1:]):
+            on = self.on_from <= start < self.on_until
+            self._propagate(end - start, (self.heating if on else 0.0) - self.cooling)
+        self.time = now
+
+    def update(self, reading, variance=None, state=SENSOR):
+        """ Fold in one reading of state (SENSOR for the thermistor, BATH
+            for a direct one), variance defaults to that sensor's
+        """
+        if variance is None:
+            variance = self.measurement_variance if state == SENSOR else self.direct_variance
+        ph = self.p[:, state].copy()
+        k = ph / (ph[state] + variance)
+        self.x += k * (reading - self.x[state])
+        self.p -= numpy.outer(k, ph)
+
+    def step(self, now, reading, direct=None):
+        """ Predict to now then update with the thermistor reading and
+            a direct one when given, each a value or a (value, variance)
+            pair. None or NaN readings are skipped. Returns (temperature,
+            rate in 'c/s).
+        """
+        readings = [(r if isinstance(r, tuple) else (r, None)) + (state,)
+                    for r, state in ((reading, SENSOR), (direct, BATH))]
+        readings = [r for r in readings if r[0] is not None and not math.isnan(r[0])]
+        if self.time is None:
+            if not readings:
+                return None, None
+            # Start settled on the first reading, rate unknown
+            value, variance, state = readings[0]
+            variance = variance or (self.measurement_variance if state == SENSOR
+                                    else self.direct_variance)
+            self.time = now
+            self.x[:] = value, value, 0.0
+            self.p = numpy.diag([variance, variance, 1e-4])
+            self.p[BATH, SENSOR] = self.p[SENSOR, BATH] = variance
+            readings = readings[1:]
+        else:
+            self.predict(now)
+        for value, variance, state in readings:
+            self.update(value, variance, state)
+        return self.temperature, self.rate
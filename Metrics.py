@@ -0,0 +1,236 @@
+""" Counters and histograms, served in the Prometheus text format.
+
+    Metrics are declared once at module level against a Registry (REGISTRY
+    by default) and updated through their labelled children:
+
+        NAKS = Counter('pybath_naks_total', "Requests the board NAK'd", ('port',))
+        naks = NAKS.labels(port='/dev/ttyUSB0')   # look up once
+        naks.inc()                                # then a lock and an add
+
+    serve() (or serve_from_config(), the [Metrics] section) exposes the
+    registry at http://host:port/metrics for scraping.
+"""
+import bisect
+import logging
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from Clock import monotonic
+
+log = logging.getLogger('Metrics')
+
+# Seconds, serial round trips at 250000 baud up to a timed out request
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                   1.0, 2.0, 5.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(n, _escape(v)) for n, v in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry( object ):
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if any(m.name == metric.name for m in self.metrics):
+                raise ValueError("Metric {0} already registered".format(metric.name))
+            self.metrics.append(metric)
+
+    def render(self):
+        """ Every metric as Prometheus exposition text """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric( object ):
+
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.label_names:
+            self._unlabelled = self.labels()
+        registry.register(self)
+
+    def labels(self, **labels):
+        """ The child for one set of label values, created on first use """
+        key = tuple(labels[n] for n in self.label_names)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self._child())
+        return child
+
+    def items(self):
+        with self.lock:
+            return sorted(self.children.items())
+
+
+class _CounterChild( object ):
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self.lock:
+            self.value += amount
+
+
+class Counter( _Metric ):
+    """ Only goes up """
+
+    kind = 'counter'
+    _child = _CounterChild
+
+    def inc(self, amount=1.0):
+        self._unlabelled.inc(amount)
+
+    def samples(self):
+        for key, child in self.items():
+            yield '{0}{1} {2}'.format(self.name, _label_text(self.label_names, key),
+                                      _number(child.value))
+
+
+class _Timer( object ):
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(monotonic() - self.start)
+
+
+class _HistogramChild( object ):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Per bucket, made cumulative when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """ Context manager observing the seconds its block took """
+        return _Timer(self)
+
+
+class Histogram( _Metric ):
+    """ Observations counted into fixed upper bound buckets """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, help, labels, registry)
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+    def time(self):
+        return self._unlabelled.time()
+
+    def samples(self):
+        for key, child in self.items():
+            with child.lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '{0}_bucket{1} {2}'.format(
+                      self.name, _label_text(self.label_names, key, [('le', _number(bound))]),
+                      cumulative)
+            labels = _label_text(self.label_names, key)
+            yield '{0}_sum{1} {2}'.format(self.name, labels, _number(total))
+            yield '{0}_count{1} {2}'.format(self.name, labels, cumulative)
+
+
+class _Handler( BaseHTTPServer.BaseHTTPRequestHandler ):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class MetricsServer( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+
+    daemon_threads = True
+
+    def __init__(self, address, registry=REGISTRY):
+        self.registry = registry
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """ Serve registry on a background thread, returns the server """
+    server = MetricsServer((host, port), registry)
+    thread = threading.Thread(target=server.serve_forever, name='Metrics')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def serve_from_config(config, section='Metrics'):
+    """ serve() on the section's Port (and Host), None when unset or 0 """
+    if not config.has_option(section, 'Port') or not config.get(section, 'Port'):
+        return None
+    port = config.getint(section, 'Port')
+    if not port:
+        return None
+    host = config.get(section, 'Host') if config.has_option(section, 'Host') else '127.0.0.1'
+    return serve(port, host)
+
@@ -0,0 +1,184 @@
+""" Run a rack of baths from one process.
+
+    Each bath gets its own thread, controller, state and PID loop. All the
+    waiting a bath does happens in poll() or sleep with the GIL released,
+    so a unit that stalls or NAKs only ever holds up its own thread, the
+    others keep to their cycle.
+
+    python MultiBath.py baths.conf
+"""
+import sys
+import time
+import logging
+import threading
+import functools
+from ConfigParser import SafeConfigParser
+
+import Clock
+from BathController import BathController
+from ControlLoop import ControlLoop, tuning_state, control_mode
+from Kalman import Kalman
+from Recorder import Recorder
+from SharedState import SharedState
+from Thermistor import Thermistor
+
+log = logging.getLogger('MultiBath')
+
+
+class Bath( object ):
+    """ One bath definition and its live runtime pieces """
+
+    def __init__(self, name, port, baud, tuning, target=None, stream_period=0,
+                 mode=ControlLoop.STAGED, recorder=None, thermistor=None, estimator=None,
+                 publisher=None, clock=None):
+        self.name = name
+        self.port = port
+        self.baud = baud
+        self.mode = mode
+        self.recorder = recorder
+        self.thermistor = thermistor
+        self.estimator = estimator
+        # Messages carry the bath's name, one publisher serves a rack
+        self.publish = publisher and functools.partial(publisher.publish, bath=name)
+        self.stream_period = stream_period
+        # Simulated time, for an emulator at --speed
+        self.clock = clock
+        self.state = SharedState(tuning)
+        # Set on the first good reading, stays set across reconnects
+        self.ready = threading.Event()
+        if target is not None:
+            self.state.update(target=target, start=True)
+        self.controller = None
+        self.loop = None
+        self.thread = None
+        self.error = None
+        self.faults = 0
+
+    def open(self):
+        self.controller = BathController(self.port, self.baud, thermistor=self.thermistor)
+        self.loop = ControlLoop(self.controller, self.state, mode=self.mode,
+                                recorder=self.recorder, estimator=self.estimator,
+                                ready=self.ready, publish=self.publish, name=self.name,
+                                clock=self.clock)
+        # Board resets when the port opens
+        time.sleep(3)
+        self.loop.get_temp()
+        if self.stream_period > 0 and self.controller.features & self.controller.feature_stream:
+            self.controller.start_streaming(self.stream_period)
+
+    def close(self):
+        controller, self.controller = self.controller, None
+        if controller is not None:
+            try:
+                controller.close()
+            except Exception:
+                log.exception("%s: close failed", self.name)
+
+
+class BathRuntime( object ):
+
+    def __init__(self, baths, retry_delay=10.0):
+        self.baths = list(baths)
+        self.retry_delay = retry_delay
+        self.stopping = threading.Event()
+
+    @classmethod
+    def from_config(cls, config, publisher=None):
+        """ A bath per [Bath <name>] section, Port, Baud, Tuning (section
+            name, default Tuning) and optional Target, Stream_Period,
+            Record (file for its cycles, sized by [Recording]),
+            Thermistor (section of its sensor curve, default Thermistor) and
+            Filter (section of its Kalman filter, default Filter) and
+            Speed (of an Emulator.py standing in for it, see Clock.py).
+            Every bath publishes to publisher when given.
+        """
+        baths = []
+        for section in config.sections():
+            if not section.startswith('Bath '):
+                continue
+            get = lambda option, default=None: (config.get(section, option)
+                                                if config.has_option(section, option)
+                                                else default)
+            target = get('Target')
+            tuning = get('Tuning', 'Tuning')
+            baths.append(Bath(section[len('Bath '):].strip(),
+                              get('Port'), get('Baud'),
+                              tuning_state(config, tuning),
+                              target=float(target) if target is not None else None,
+                              stream_period=int(get('Stream_Period', 0)),
+                              mode=control_mode(config, tuning),
+                              recorder=get('Record') and Recorder.from_config(
+                                  config, path=get('Record')),
+                              thermistor=Thermistor.from_config(
+                                  config, get('Thermistor', 'Thermistor')),
+                              estimator=Kalman.from_config(config, get('Filter', 'Filter')),
+                              publisher=publisher,
+                              clock=Clock.from_config(config, section)))
+        return cls(baths)
+
+    def alive(self):
+        return not self.stopping.is_set()
+
+    def start(self):
+        self.stopping.clear()
+        for bath in self.baths:
+            bath.thread = threading.Thread(target=self._run, args=(bath,),
+                                           name='Bath ' + bath.name)
+            bath.thread.daemon = True
+            bath.thread.start()
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        self.join(timeout)
+
+    def join(self, timeout=None):
+        for bath in self.baths:
+            if bath.thread is not None:
+                bath.thread.join(timeout)
+
+    def status(self):
+        """ name -> snapshot of the bath's state plus fault info """
+        status = {}
+        for bath in self.baths:
+            s = bath.state.snapshot()
+            s.update(connected=bath.controller is not None,
+                     faults=bath.faults, error=bath.error and str(bath.error),
+                     cycles=bath.loop and bath.loop.scheduler.stats())
+            status[bath.name] = s
+        return status
+
+    def _run(self, bath):
+        # Any failure is this bath's alone, drop the port and retry
+        while self.alive():
+            try:
+                if bath.controller is None:
+                    bath.open()
+                    bath.error = None
+                bath.loop.run(self.alive)
+            except Exception as e:
+                bath.faults += 1
+                bath.error = e
+                bath.state['data_fresh'] = False
+                log.exception("%s: fault %d", bath.name, bath.faults)
+                bath.close()
+                self.stopping.wait(self.retry_delay)
+        bath.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(threadName)s %(message)s')
+    config = SafeConfigParser()
+    config.read(sys.argv[1] if len(sys.argv) > 1 else 'baths.conf')
+    runtime = BathRuntime.from_config(config)
+    if not runtime.baths:
+        sys.exit("No [Bath <name>] sections configured")
+    runtime.start()
+    try:
+        while True:
+            time.sleep(60)
+            for name, s in sorted(runtime.status().items()):
+                log.info("%s: bath %s env %s target %s faults %d", name,
+                         s['bath_temp'], s['env_temp'], s['target'], s['faults'])
+    except KeyboardInterrupt:
+        runtime.stop()
@@ -1,34 +1,81 @@
 import time
+import numpy
 
-class control:
-    """ PID control class.
+class bank( object ):
+    """ N independent PID loops stepped together on numpy state vectors.
+        Gains may be scalars or per-loop arrays, dt is given explicitly
+        per step, so the bank has no clock of its own.
     """
-    def __init__(self, Kp, Ki, Kd):
+    def __init__(self, n, Kp=0.0, Ki=0.0, Kd=0.0):
 
+        self.n = n
         # Gain variables
-        self.Kp = Kp
-        self.Kd = Ki
-        self.Ki = Kd
-        self.prev_err = 0
+        self.Kp = numpy.zeros(n) + Kp
+        self.Ki = numpy.zeros(n) + Ki
+        self.Kd = numpy.zeros(n) + Kd
+        self.prev_err = numpy.zeros(n)
         # Result variables
-        self.Cp = 0
-        self.Ci = 0
-        self.Cd = 0
+        self.Cp = numpy.zeros(n)
+        self.Ci = numpy.zeros(n)
+        self.Cd = numpy.zeros(n)
+
+    def reset(self, loops=slice(None)):
+        """ Clear integrator and error history of some or all loops """
+        self.prev_err[loops] = 0
+        self.Cp[loops] = 0
+        self.Ci[loops] = 0
+        self.Cd[loops] = 0
+
+    def step(self, error, dt):
+        """ Advance every loop by dt with its error signal, returns the
+            array of control values.
+        """
+        error = numpy.asarray(error, dtype=float)
+        dt = numpy.zeros(self.n) + dt
+        de = error - self.prev_err                              # delta error
+
+        numpy.multiply(self.Kp, error, out=self.Cp)             # proportional term
+        self.Ci += error * dt                                   # integral term
+        self.Cd[:] = 0                                          # no div by zero
+        numpy.divide(de, dt, out=self.Cd, where=dt > 0)         # derivative term
+
+        self.prev_err[:] = error                                # save t-1 error
+
+        # sum the terms and return the result
+        return self.Cp + (self.Ki * self.Ci) + (self.Kd * self.Cd)
+
+class control( object ):
+    """ PID control class.
+        A single loop, a thin wrapper over a bank of one.
+    """
+    def __init__(self, Kp, Ki, Kd, clock=time.time):
+
+        self.bank = bank(1, Kp, Ki, Kd)
         # initialize delta t variables
-        self.currtm = time.time()
+        self.clock = clock
+        self.currtm = self.clock()
         self.prevtm = self.currtm
 
+    Kp = property(lambda self: float(self.bank.Kp[0]), lambda self, v: self.setKp(v))
+    Ki = property(lambda self: float(self.bank.Ki[0]), lambda self, v: self.setKi(v))
+    Kd = property(lambda self: float(self.bank.Kd[0]), lambda self, v: self.setKd(v))
+    Cp = property(lambda self: float(self.bank.Cp[0]))
+    Ci = property(lambda self: float(self.bank.Ci[0]))
+    Cd = property(lambda self: float(self.bank.Cd[0]))
+    prev_err = property(lambda self: float(self.bank.prev_err[0]),
+                        lambda self, v: self.setPrevErr(v))
+
     def setKp(self, invar):
         """ Set proportional gain. """
-        self.Kp = invar
+        self.bank.Kp[0] = invar
 
     def setKi(self, invar):
         """ Set integral gain. """
-        self.Ki = invar
+        self.bank.Ki[0] = invar
 
     def setKd(self, invar):
         """ Set derivative gain. """
-        self.Kd = invar
+        self.bank.Kd[0] = invar
 
     def getKp(self):
         """ Set proportional gain. """
@@ -44,26 +91,14 @@ class control:
 
     def setPrevErr(self, preverr):
         """ Set previous error value. """
-        self.prev_err = preverr
+        self.bank.prev_err[0] = preverr
 
     def genOut(self, error):
         """ Performs PID computation and returns a control value based on
             the elapsed time (dt) and the error signal from a summing junction
             (the error parameter).
         """
-        self.currtm = time.time()               # get t
+        self.currtm = self.clock()              # get t
         dt = self.currtm - self.prevtm          # get delta t
-        de = error - self.prev_err              # get delta error
-
-        self.Cp = self.Kp * error               # proportional term
-        self.Ci += error * dt                   # integral term
-
-        self.Cd = 0
-        if dt > 0:                              # no div by zero
-            self.Cd = de/dt                     # derivative term
-
         self.prevtm = self.currtm               # save t for next pass
-        self.prev_err = error                   # save t-1 error
-
-        # sum the terms and return the result
-        return self.Cp + (self.Ki * self.Ci) + (self.Kd * self.Cd)
\ No newline at end of file
+        return float(self.bank.step((error,), dt)[0])
\ No newline at end of file
@@ -0,0 +1,118 @@
+""" Wire formats shared by BathController and the firmware emulator.
+
+    Every layout is a precompiled struct.Struct, packed into and decoded
+    from preallocated buffers. v1 checksums are one C level sum() over
+    the packet, the v2 CRC is binascii's CRC-CCITT, so no per byte Python
+    loop is left on either side of the link.
+
+    v1 packets, 64 bytes, last byte the sum of the others mod 255
+
+        temperatures  >HH B H 56x B env, bath ('c * 100), features, IR
+                                    bath ('c * 100, 0 without FEATURE_IR)
+        element time  >I 59x B      on time, ms
+
+    v2 frames, STX length command data CRC-16/CCITT-FALSE over length
+    to data. Temperature data is env, bath, features, with the IR
+    reading after them on firmware that has FEATURE_IR.
+"""
+import struct
+import binascii
+
+import numpy
+
+PKT_SZ = 64
+FRAME_START = b"\x02"
+FRAME_MAX_DATA = 16
+
+TEMPERATURE_PACKET = struct.Struct('>HHBH56xB')
+ELEMENT_PACKET = struct.Struct('>I59xB')
+# v2 data fields
+ELEMENT_TIME = struct.Struct('>I')
+TEMPERATURES = struct.Struct('>HHB')
+IR_TEMPERATURE = struct.Struct('>H')
+STREAM_PERIOD = struct.Struct('>H')
+RAW_SAMPLES = struct.Struct('B')
+# Telemetry data is a millis() timestamp then the temperature data
+TELEMETRY_TIME = struct.Struct('>I')
+FRAME_HEAD = struct.Struct('BB')
+CRC = struct.Struct('>H')
+
+# Pushed telemetry frame data as an array, for decoding a batch at once
+TELEMETRY = numpy.dtype([('device_ms', '>u4'), ('env', '>u2'), ('bath', '>u2'),
+                         ('features', 'u1')])
+TELEMETRY_IR = numpy.dtype(TELEMETRY.descr + [('ir', '>u2')])
+
+
+def crc16(data, crc=0xFFFF):
+    """ CRC-16/CCITT-FALSE, matches avr-libc _crc_xmodem_update seeded 0xFFFF """
+    return binascii.crc_hqx(data, crc)
+
+
+def valid(packet):
+    """ Whether a v1 packet's last byte matches the sum of the rest """
+    if not isinstance(packet, bytearray):
+        packet = bytearray(packet)
+    last = packet[-1]
+    return (sum(packet) - last) % 255 == last
+
+
+class PacketCodec( object ):
+    """ Encoding and decoding for one end of a link. Holds its own
+        buffers, packets are read into self.packet (see
+        SerialTransport.readinto) and encoded ones are only valid until
+        the next encode.
+    """
+
+    def __init__(self):
+        self.packet = bytearray(PKT_SZ)
+        self.packet_view = memoryview(self.packet)
+        self.out = bytearray(PKT_SZ)
+        self.frame = bytearray(1 + FRAME_HEAD.size + FRAME_MAX_DATA + CRC.size)
+
+    def _seal(self):
+        """ Checksum into the last byte of the outgoing packet """
+        self.out[PKT_SZ - 1] = sum(self.out) % 255
+        return self.out
+
+    def encode_temperatures(self, env, bath, features, ir=0):
+        TEMPERATURE_PACKET.pack_into(self.out, 0, env, bath, features, ir, 0)
+        return self._seal()
+
+    def decode_temperatures(self, packet=None):
+        """ (env, bath, features, ir) raw fields, None on a bad checksum """
+        packet = self.packet if packet is None else packet
+        if not valid(packet):
+            return None
+        return TEMPERATURE_PACKET.unpack_from(packet)[:4]
+
+    def encode_element(self, on_time):
+        ELEMENT_PACKET.pack_into(self.out, 0, on_time, 0)
+        return self._seal()
+
+    def decode_element(self, packet=None):
+        """ On time in ms, None on a bad checksum """
+        packet = self.packet if packet is None else packet
+        if not valid(packet):
+            return None
+        return ELEMENT_PACKET.unpack_from(packet)[0]
+
+    def encode_frame(self, code, data=b""):
+        """ STX, length, code (command or status), data, CRC as bytes """
+        n = len(data)
+        if n > FRAME_MAX_DATA:
+            raise ValueError("{0} bytes is more than a frame holds".format(n))
+        frame = self.frame
+        frame[0] = ord(FRAME_START)
+        FRAME_HEAD.pack_into(frame, 1, n + 1, ord(code) if isinstance(code, bytes) else code)
+        frame[3:3 + n] = data
+        CRC.pack_into(frame, 3 + n, crc16(buffer(frame, 1, n + 2)))
+        return bytes(frame[:5 + n])
+
+    @staticmethod
+    def check_frame(body):
+        """ body is a frame after its STX: length, code, data, CRC.
+            Returns code and data, None if it failed the CRC.
+        """
+        if crc16(body[:-2]) != CRC.unpack_from(body, len(body) - 2)[0]:
+            return None
+        return body[1:-2]
@@ -0,0 +1,25 @@
+""" Bath energy model, shared by the control loop and anything that
+    simulates a bath.
+"""
+
+
+def resistance_to_watts(resistance, voltage):
+    """ Calculate element wattage from resitance and voltage """
+    return (voltage**2)/resistance
+
+def joules_to_watt_seconds(joules, element_wattage):
+    """ Calculate element time from energy in joules """
+    return float(joules/element_wattage)
+
+def temperature_to_joules(temp_obj, temp_amb, mass_kg, heat_capacity):
+    """ Calculate energy contained within the bath medium """
+    # 4.184 is cal -> joule, specific heat is cal/g/c, we want joule/g/k
+    return float((heat_capacity * (mass_kg*1000) * (temp_obj - temp_amb))/4.184)
+
+def boltzmann_loss(emissivity, area, temp_obj, temp_amb):
+    """ Calculate the energy radiated at a given temperature """
+    temp_amb += 273.15
+    temp_obj += 273.15
+    boltzmann_const = 5.670373e-8# W * m^-2 * K^-4
+    a = area*((temp_obj**4) - (temp_amb**4))# A(T^4 - Tc^4)
+    return emissivity*boltzmann_const*a
@@ -0,0 +1,121 @@
+""" Thermal model of a bath for running the controller without hardware.
+
+    The medium gains the element's energy while it is on and loses
+    boltzmann_loss() to the room, using the same energy model as the
+    control loop. The thermistor reading follows the medium through a
+    first order lag, with optional noise. ir_noise adds a direct reading
+    of the medium like the IR sensor's, None for a bath without one.
+"""
+import math
+import random
+
+from Physics import resistance_to_watts, temperature_to_joules, boltzmann_loss
+
+
+class BathPlant( object ):
+
+    def __init__(self, clock, mass, heat_capacity, emissivity, area, watts,
+                 env_temp=21.0, bath_temp=None, sensor_tau=20.0, noise=0.0,
+                 seed=None, step=1.0, ir_noise=None):
+        self.clock = clock
+        self.mass = mass
+        self.heat_capacity = heat_capacity
+        self.emissivity = emissivity
+        self.area = area
+        self.watts = watts
+        self.env_temp = env_temp
+        self.bath_temp = env_temp if bath_temp is None else bath_temp
+        self.sensor_temp = self.bath_temp
+        self.sensor_tau = sensor_tau
+        self.noise = noise
+        self.ir_noise = ir_noise
+        self.random = random.Random(seed)
+        self.step = step
+        # Joules per degree, inverse of temperature_to_joules
+        self.capacity = temperature_to_joules(1.0, 0.0, mass, heat_capacity)
+        self.time = clock()
+        self.element_off_at = self.time
+        self.energy_used = 0.0
+
+    @classmethod
+    def from_config(cls, config, clock, section='Tuning', **kwargs):
+        get = lambda option: float(config.get(section, option))
+        return cls(clock, get('Mass'), get('Heat_Capacity'), get('Emissivity'),
+                   get('Area'), resistance_to_watts(get('Resistance'), get('Voltage')),
+                   **kwargs)
+
+    def set_element(self, on_ms):
+        """ Element on for on_ms from now, like the firmware's off_time """
+        self.advance()
+        self.element_off_at = self.time + on_ms / 1000.0
+
+    @property
+    def element_on(self):
+        return self.clock() < self.element_off_at
+
+    def advance(self):
+        """ Integrate up to the clock's current time """
+        now = self.clock()
+        while self.time < now:
+            dt = min(self.step, now - self.time)
+            on = max(0.0, min(self.element_off_at, self.time + dt) - self.time)
+            heat = self.watts * on
+            loss = boltzmann_loss(self.emissivity, self.area,
+                                  self.bath_temp, self.env_temp) * dt
+            self.energy_used += heat
+            start = self.bath_temp
+            self.bath_temp += (heat - loss) / self.capacity
+            if self.sensor_tau > 0:
+                # Exact response to the bath ramping from start over dt
+                tau = self.sensor_tau
+                fade = math.exp(-dt / tau)
+                ramp = (self.bath_temp - start) / dt
+                self.sensor_temp = (fade * self.sensor_temp + (1 - fade) * start
+                                    + (dt - tau * (1 - fade)) * ramp)
+            else:
+                self.sensor_temp = self.bath_temp
+            self.time += dt
+
+    def temperatures(self):
+        """ Environment and thermistor reading, 0.01 degree resolution
+            like the firmware packet
+        """
+        self.advance()
+        bath = self.sensor_temp
+        if self.noise:
+            bath += self.random.gauss(0.0, self.noise)
+        return round(self.env_temp, 2), round(bath, 2)
+
+    def ir_temperature(self):
+        """ Direct reading of the medium, None without an IR sensor """
+        if self.ir_noise is None:
+            return None
+        self.advance()
+        return round(self.bath_temp + self.random.gauss(0.0, self.ir_noise), 2)
+
+
+class SimulatedController( object ):
+    """ BathController stand-in wired straight to a plant, no serial
+        line, for simulations that need the control loop as is.
+    """
+
+    def __init__(self, plant):
+        self.plant = plant
+        self.features = 0
+        self.protocol = 1
+        self.ir_temp = None
+
+    def get_temperatures(self):
+        temperatures = self.plant.temperatures()
+        self.ir_temp = self.plant.ir_temperature()
+        return temperatures
+
+    def set_element_time(self, on_time):
+        self.plant.set_element(on_time)
+
+    def set_element_and_get_temperatures(self, on_time):
+        self.set_element_time(on_time)
+        return self.get_temperatures()
+
+    def close(self):
+        pass
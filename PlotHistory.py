@@ -0,0 +1,91 @@
+""" What the GUI's plot shows, kept apart from Qt and gr.
+
+    Readings go into a bounded RingBuffer and mark the history dirty.
+    refresh(), on the redraw tick, brings the curves up to date. New
+    samples are appended to the points already drawn. The whole history
+    is LTTB decimated afresh, to about a point per pixel, only when it
+    was reset, the plot changed width or the appended tail has doubled
+    the points. A tick with nothing new does nothing.
+"""
+import numpy
+
+from Decimate import lttb
+from RingBuffer import RingBuffer
+
+# Samples held for the plot, five days at the 5 s update
+CAPACITY = 86400
+
+
+class PlotHistory( object ):
+    """ env and bath are the curves' (x, y) arrays, window the axes'
+        (xmin, xmax, ymin, ymax), grown with headroom so it only
+        changes every so often
+    """
+
+    def __init__(self, capacity=CAPACITY):
+        self.samples = RingBuffer(capacity, ('time', 'env_temp', 'bath_temp'))
+        self.dirty = False
+        self.shown_total = 0
+        self.shown_width = 0
+        self.env = self.bath = (numpy.zeros(0), numpy.zeros(0))
+        self.window = None
+
+    def add(self, t, env_temp, bath_temp):
+        """ One reading, drawn on the next refresh() """
+        self.samples.append(t, env_temp, bath_temp)
+        self.dirty = True
+
+    def reset(self, t, env_temp, bath_temp):
+        """ Start again from one reading """
+        self.samples.clear()
+        # Nothing drawn is kept, the next refresh() decimates afresh
+        self.shown_total = 0
+        self.env = self.bath = (numpy.zeros(0), numpy.zeros(0))
+        self.window = None
+        self.add(t, env_temp, bath_temp)
+
+    def refresh(self, width):
+        """ Bring the curves up to date for a plot width pixels wide.
+            Returns 'decimated', 'appended' or None when there was
+            nothing to draw.
+        """
+        if not self.dirty:
+            return None
+        self.dirty = False
+        new = self.samples.total - self.shown_total
+        width = max(width, 3)
+        if (new <= 0 or not self.shown_total or new >= len(self.samples)
+                or width != self.shown_width or len(self.bath[0]) + new > 2 * width):
+            self._decimate(width)
+            return 'decimated'
+        self._append(new)
+        return 'appended'
+
+    def _decimate(self, width):
+        h = self.samples.arrays()
+        self.env = lttb(h['time'], h['env_temp'], width)
+        self.bath = lttb(h['time'], h['bath_temp'], width)
+        self.shown_total = self.samples.total
+        self.shown_width = width
+        self._fit_window(h['time'], h['env_temp'], h['bath_temp'])
+
+    def _append(self, new):
+        h = self.samples.arrays(last=new)
+        self.env = (numpy.append(self.env[0], h['time']), numpy.append(self.env[1], h['env_temp']))
+        self.bath = (numpy.append(self.bath[0], h['time']),
+                     numpy.append(self.bath[1], h['bath_temp']))
+        self.shown_total = self.samples.total
+        self._fit_window(h['time'], h['env_temp'], h['bath_temp'])
+
+    def _fit_window(self, t, *temps):
+        if not len(t):
+            return
+        low = min(numpy.nanmin(y) for y in temps)
+        high = max(numpy.nanmax(y) for y in temps)
+        if self.window is not None:
+            xmin, xmax, ymin, ymax = self.window
+            if t[-1] <= xmax and low >= ymin and high <= ymax:
+                return
+            low, high = min(low, ymin), max(high, ymax)
+        xmax = max(60.0, float(t[-1]) * 1.5)
+        self.window = (0.0, xmax, numpy.floor(low) - 1.0, numpy.ceil(high) + 1.0)
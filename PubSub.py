@@ -0,0 +1,230 @@
+""" Live telemetry fan-out to any number of local monitors.
+
+    The control loop publishes every reading ('sample') and control cycle
+    ('cycle') to a Publisher, which costs it a deque append. A thread of
+    the publisher's own encodes each message once, as a JSON line, and
+    copies it out to every subscriber on a Unix socket, never blocking on
+    any of them. A subscriber that falls more than max_pending bytes
+    behind is conflated, its backlog cut down to the newest message of
+    each topic, and dropped if even that won't fit. Nothing a monitor
+    does reaches the serial link or the loop.
+
+    python PubSub.py /tmp/pybath.pub [topic ...]
+
+    A subscriber may send one line of space separated topics after
+    connecting to only get those, the default is everything.
+"""
+import os
+import sys
+import json
+import errno
+import fcntl
+import socket
+import select
+import logging
+import threading
+import collections
+
+log = logging.getLogger('PubSub')
+
+SOCKET = '/tmp/pybath.pub'
+
+
+def _nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class _Subscriber( object ):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.topics = None
+        self.request = ''
+        # (topic, line) waiting to go, sent bytes of the first
+        self.lines = collections.deque()
+        self.sent = 0
+        self.pending = 0
+        self.conflated = 0
+
+    def push(self, topic, line):
+        if self.topics is None or topic in self.topics:
+            self.lines.append((topic, line))
+            self.pending += len(line)
+
+    def conflate(self):
+        """ Newest line of each topic, keeping one already half sent """
+        head = [self.lines.popleft()] if self.sent else []
+        newest = collections.OrderedDict()
+        for topic, line in self.lines:
+            newest.pop(topic, None)
+            newest[topic] = line
+        self.conflated += len(self.lines) - len(newest)
+        self.lines = collections.deque(head + list(newest.items()))
+        self.pending = sum(len(line) for topic, line in self.lines) - self.sent
+
+    def flush(self):
+        """ Send what the socket takes without blocking """
+        while self.lines:
+            line = self.lines[0][1]
+            n = self.sock.send(line[self.sent:])
+            self.sent += n
+            self.pending -= n
+            if self.sent < len(line):
+                return
+            self.lines.popleft()
+            self.sent = 0
+
+
+class Publisher( object ):
+    """ path - Unix socket subscribers connect to
+        max_pending - bytes a subscriber may fall behind before conflation
+        backlog - messages held for the sender thread before the oldest
+                  are lost (only if it stalls altogether)
+    """
+
+    def __init__(self, path=SOCKET, max_pending=256 * 1024, backlog=4096):
+        self.path = path
+        self.max_pending = max_pending
+        self.queue = collections.deque(maxlen=backlog)
+        self.subscribers = []
+        self.dropped = 0
+        self.published = 0
+        self.listener = None
+        self.thread = None
+        self.stopping = False
+        self.wake_r, self.wake_w = os.pipe()
+        _nonblocking(self.wake_r)
+        _nonblocking(self.wake_w)
+
+    @classmethod
+    def from_config(cls, config, section='Daemon'):
+        """ Started publisher on the section's Publish path, None when unset """
+        if not config.has_option(section, 'Publish') or not config.get(section, 'Publish'):
+            return None
+        publisher = cls(config.get(section, 'Publish'))
+        publisher.start()
+        return publisher
+
+    def start(self):
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(16)
+        self.listener.setblocking(False)
+        self.thread = threading.Thread(target=self._run, name='Publisher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, topic, **fields):
+        """ Queue one message, from any thread, never blocks """
+        fields['topic'] = topic
+        self.queue.append(fields)
+        try:
+            os.write(self.wake_w, b'.')
+        except OSError as e:
+            # Pipe full, the sender is awake already
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        self.stopping = True
+        os.write(self.wake_w, b'.')
+        if self.thread is not None:
+            self.thread.join()
+        for subscriber in self.subscribers:
+            subscriber.sock.close()
+        if self.listener is not None:
+            self.listener.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _drop(self, subscriber, why):
+        log.info("Dropping subscriber: %s", why)
+        self.subscribers.remove(subscriber)
+        self.dropped += 1
+        subscriber.sock.close()
+
+    def _fan_out(self):
+        while self.queue:
+            message = self.queue.popleft()
+            line = json.dumps(message) + '\n'
+            self.published += 1
+            for subscriber in self.subscribers:
+                subscriber.push(message['topic'], line)
+        for subscriber in list(self.subscribers):
+            if subscriber.pending > self.max_pending:
+                subscriber.conflate()
+                if subscriber.pending > self.max_pending:
+                    self._drop(subscriber, "too slow")
+
+    def _read(self, subscriber):
+        data = subscriber.sock.recv(4096)
+        if not data:
+            self._drop(subscriber, "closed")
+            return
+        subscriber.request += data
+        if '\n' in subscriber.request:
+            line = subscriber.request.split('\n', 1)[0]
+            subscriber.topics = frozenset(line.split()) or None
+            subscriber.request = ''
+
+    def _run(self):
+        while not self.stopping:
+            readers = [self.listener, self.wake_r] + [s.sock for s in self.subscribers]
+            writers = [s.sock for s in self.subscribers if s.lines]
+            readable, _, _ = select.select(readers, writers, [])
+            by_sock = dict((s.sock, s) for s in self.subscribers)
+            for sock in readable:
+                if sock is self.listener:
+                    try:
+                        conn, _ = self.listener.accept()
+                    except socket.error:
+                        continue
+                    conn.setblocking(False)
+                    self.subscribers.append(_Subscriber(conn))
+                elif sock == self.wake_r:
+                    try:
+                        while os.read(self.wake_r, 4096):
+                            pass
+                    except OSError:
+                        pass
+                elif sock in by_sock:
+                    try:
+                        self._read(by_sock[sock])
+                    except socket.error as e:
+                        self._drop(by_sock[sock], e)
+            self._fan_out()
+            # Straight out to whoever has room, select waits on the rest
+            for subscriber in [s for s in self.subscribers if s.lines]:
+                try:
+                    subscriber.flush()
+                except socket.error as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        self._drop(subscriber, e)
+
+
+def subscribe(path=SOCKET, topics=None):
+    """ Messages from a Publisher as dicts, until it goes away """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    if topics:
+        sock.sendall(' '.join(topics) + '\n')
+    lines = sock.makefile('rb')
+    try:
+        for line in iter(lines.readline, ''):
+            yield json.loads(line)
+    finally:
+        lines.close()
+        sock.close()
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else SOCKET
+    for message in subscribe(path, sys.argv[2:]):
+        print json.dumps(message, sort_keys=True)
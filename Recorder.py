@@ -0,0 +1,200 @@
+""" Append-only binary record of every control cycle.
+
+    Each file is a 64 byte header followed by fixed size RECORD entries,
+    preallocated to max_bytes and written through a memory map, so a
+    cycle costs one slot assignment rather than formatting text. When a
+    file fills it is rotated to <path>.1 (and .1 to .2 and so on, keeping
+    backups of them) and a fresh one started. A recording left by an
+    earlier run is rotated the same way on start, never overwritten,
+    with no backups it is moved aside to <path>.<date>-<time> instead.
+
+    read() maps a file back as a NumPy structured array, read_all() joins
+    a path and its rotations oldest first.
+
+    python Recorder.py pybath.rec
+"""
+import os
+import sys
+import mmap
+import time
+import struct
+
+import numpy
+
+from Clock import monotonic
+
+RECORD = numpy.dtype([
+    ('time', '<f8'),            # monotonic seconds
+    ('env_temp', '<f4'),
+    ('bath_temp', '<f4'),
+    ('set_point', '<f8'),       # joules
+    ('deficit', '<f8'),         # joules
+    ('p_term', '<f8'),
+    ('i_term', '<f8'),
+    ('d_term', '<f8'),
+    ('feedforward', '<f8'),     # model joules, 0 in staged mode
+    ('element_time', '<f4'),    # seconds sent to the element
+    ('divisor', '<f4'),         # staged gain divisor, 0 when the PID didn't run
+    ('control_mode', 'u1'),     # index into CONTROL_MODES
+    ('pad', 'V3'),
+    ('bath_rate', '<f4'),       # filtered 'c/s, 0 without an estimator
+])
+
+CONTROL_MODES = ('staged', 'feedforward')
+
+MAGIC = b'PYBATHR1'
+# magic, record size, records written, wall and monotonic time at creation
+HEADER = struct.Struct('<8sIQdd')
+HEADER_SIZE = 64
+
+
+class Recorder( object ):
+
+    def __init__(self, path, max_bytes=16 * 1024 * 1024, backups=5):
+        self.path = path
+        self.capacity = max(1, (max_bytes - HEADER_SIZE) // RECORD.itemsize)
+        self.backups = backups
+        self.file = None
+        self.map = None
+        if _holds_records(path):
+            if backups:
+                self._shift()
+            else:
+                _set_aside(path)
+        self._open()
+
+    @classmethod
+    def from_config(cls, config, section='Recording', path=None):
+        """ Recorder for the Path, Max_MB and Backups options of section,
+            None when recording isn't configured. path overrides Path.
+        """
+        get = lambda option, default: (config.get(section, option)
+                                       if config.has_option(section, option) else default)
+        path = path or get('Path', '').strip()
+        if not path:
+            return None
+        return cls(path, int(float(get('Max_MB', 16)) * 1024 * 1024), int(get('Backups', 5)))
+
+    def _open(self):
+        size = HEADER_SIZE + self.capacity * RECORD.itemsize
+        self.file = open(self.path, 'w+b')
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.records = numpy.frombuffer(self.map, dtype=RECORD, count=self.capacity,
+                                        offset=HEADER_SIZE)
+        self.count = 0
+        self.created = time.time(), monotonic()
+        self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, RECORD.itemsize, self.count, *self.created)
+
+    def _shift(self):
+        """ path to path.1, path.1 to path.2 and so on """
+        for n in range(self.backups - 1, 0, -1):
+            older = '{0}.{1}'.format(self.path, n)
+            if os.path.exists(older):
+                os.rename(older, '{0}.{1}'.format(self.path, n + 1))
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+
+    def _rotate(self):
+        self.close()
+        self._shift()
+        self._open()
+
+    def record(self, **fields):
+        """ Append one cycle, missing fields are recorded as 0 """
+        if self.count == self.capacity:
+            self._rotate()
+        row = numpy.zeros((), RECORD)
+        for name, value in fields.items():
+            row[name] = value
+        self.records[self.count] = row
+        # Count last, a reader never sees a half written record
+        self.count += 1
+        self._write_header()
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.records = None
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+            self.map = self.file = None
+
+
+def _holds_records(path):
+    """ Whether path exists and isn't an empty recording, anything
+        unreadable counts as worth keeping
+    """
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(path, 'rb') as f:
+            magic, size, count = HEADER.unpack(f.read(HEADER.size))[:3]
+    except (IOError, struct.error):
+        return True
+    return magic != MAGIC or count > 0
+
+
+def _set_aside(path):
+    """ Rename path after the time it was last written, a counter
+        added if that name is taken
+    """
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(os.path.getmtime(path)))
+    target = '{0}.{1}'.format(path, stamp)
+    n = 1
+    while os.path.exists(target):
+        target = '{0}.{1}-{2}'.format(path, stamp, n)
+        n += 1
+    os.rename(path, target)
+    return target
+
+
+def read(path):
+    """ Records of one file as a structured array, a read-only map """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    magic, size, count, wall, mono = HEADER.unpack(header)
+    if magic != MAGIC or size != RECORD.itemsize:
+        raise ValueError("{0} is not a pyBath record file".format(path))
+    if not count:
+        return numpy.zeros(0, RECORD)
+    return numpy.memmap(path, dtype=RECORD, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+
+def read_all(path):
+    """ A file and its rotations oldest first, joined into one array """
+    paths = []
+    n = 1
+    while os.path.exists('{0}.{1}'.format(path, n)):
+        paths.insert(0, '{0}.{1}'.format(path, n))
+        n += 1
+    if os.path.exists(path):
+        paths.append(path)
+    if not paths:
+        return numpy.zeros(0, RECORD)
+    return numpy.concatenate([read(p) for p in paths])
+
+
+def created(path):
+    """ (wall time, monotonic time) the file was started at, for turning
+        record times into dates
+    """
+    with open(path, 'rb') as f:
+        return HEADER.unpack(f.read(HEADER.size))[3:]
+
+
+if __name__ == "__main__":
+    records = read_all(sys.argv[1] if len(sys.argv) > 1 else 'pybath.rec')
+    print "{0:>10} {1:>8} {2:>8} {3:>12} {4:>10} {5:>8} {6:>12}".format(
+          'time', 'env', 'bath', 'deficit J', 'element s', 'divisor', 'mode')
+    for r in records:
+        print "{0:10.1f} {1:8.2f} {2:8.2f} {3:12.0f} {4:10.3f} {5:8.0f} {6:>12}".format(
+              r['time'], r['env_temp'], r['bath_temp'], r['deficit'],
+              r['element_time'], r['divisor'], CONTROL_MODES[r['control_mode']])
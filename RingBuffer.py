@@ -0,0 +1,60 @@
+import threading
+import numpy
+
+
+class RingBuffer( object ):
+    """ Fixed capacity, column per field sample store.
+
+        Appends overwrite the oldest sample once full, memory use never
+        grows. Safe for one writer thread and any number of readers.
+    """
+
+    def __init__(self, capacity, fields=('time', 'env_temp', 'bath_temp')):
+        self.capacity = capacity
+        self.fields = tuple(fields)
+        self.data = numpy.zeros((len(self.fields), capacity))
+        self.total = 0 # samples ever appended
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def append(self, *values):
+        """ Add one sample, values in field order """
+        with self.lock:
+            self.data[:, self.total % self.capacity] = values
+            self.total += 1
+
+    def extend(self, columns):
+        """ Add a block of samples, one sequence per field """
+        columns = numpy.asarray(columns, dtype=float)
+        n = columns.shape[1]
+        if n > self.capacity:
+            columns = columns[:, -self.capacity:]
+        with self.lock:
+            # Where the kept tail would have gone had all n been written
+            start = (self.total + n - columns.shape[1]) % self.capacity
+            idx = (numpy.arange(columns.shape[1]) + start) % self.capacity
+            self.data[:, idx] = columns
+            self.total += n
+
+    def latest(self):
+        """ Newest sample as a tuple, None when empty """
+        with self.lock:
+            if not self.total:
+                return None
+            return tuple(self.data[:, (self.total - 1) % self.capacity])
+
+    def arrays(self, last=None):
+        """ Copy of the held samples oldest first, field -> array """
+        with self.lock:
+            n = len(self)
+            if last is not None:
+                n = min(n, last)
+            idx = numpy.arange(self.total - n, self.total) % self.capacity
+            block = self.data[:, idx]
+        return dict(zip(self.fields, block))
+
+    def clear(self):
+        with self.lock:
+            self.total = 0
@@ -0,0 +1,86 @@
+import time
+import numpy
+
+from Clock import monotonic
+from RingBuffer import RingBuffer
+
+
+class CycleScheduler( object ):
+    """ Fires cycles on absolute monotonic deadlines, start + n * period.
+
+        Deadlines never drift with how long a cycle took or with wall
+        clock changes. A cycle that runs past the next deadline is an
+        overrun, policy says what happens then:
+
+        skip     - drop the missed slots, carry on at the next one ahead
+        catch-up - run the missed slots back to back until on time again
+
+        Lateness (start - deadline) and execution time of the most recent
+        cycles are kept for stats().
+    """
+
+    SKIP = 'skip'
+    CATCH_UP = 'catch-up'
+
+    def __init__(self, period, policy=SKIP, clock=monotonic, sleep=time.sleep,
+                 history=1024):
+        if policy not in (self.SKIP, self.CATCH_UP):
+            raise ValueError("Unknown overrun policy {0}".format(policy))
+        self.period = period
+        self.policy = policy
+        self.clock = clock
+        self.sleep = sleep
+        self.history = RingBuffer(history, ('deadline', 'lateness', 'duration'))
+        self.deadline = None
+        self.started = None
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+
+    def start(self):
+        """ First deadline is now """
+        self.deadline = self.clock()
+        self.started = None
+
+    def wait(self, alive=lambda: True, step=0.5):
+        """ Sleep until the next deadline, returns how late the cycle
+            starts. alive() is checked every step seconds, returns None
+            early when it goes False.
+        """
+        if self.deadline is None:
+            self.start()
+        while True:
+            remaining = self.deadline - self.clock()
+            if remaining <= 0:
+                break
+            if not alive():
+                return None
+            self.sleep(min(remaining, step))
+        self.started = self.clock()
+        return self.started - self.deadline
+
+    def done(self):
+        """ Close the cycle opened by wait() and work out the next deadline """
+        end = self.clock()
+        lateness = self.started - self.deadline
+        self.history.append(self.deadline, lateness, end - self.started)
+        self.cycles += 1
+        self.deadline += self.period
+        if end > self.deadline:
+            self.overruns += 1
+            if self.policy == self.SKIP:
+                missed = int((end - self.deadline) // self.period) + 1
+                self.skipped += missed
+                self.deadline += missed * self.period
+
+    def stats(self):
+        """ Jitter summary over the held history """
+        h = self.history.arrays()
+        stats = {'cycles': self.cycles, 'overruns': self.overruns,
+                 'skipped': self.skipped, 'period': self.period}
+        for name in ('lateness', 'duration'):
+            v = h[name]
+            if len(v):
+                stats[name] = {'mean': float(v.mean()), 'max': float(v.max()),
+                               'p99': float(numpy.percentile(v, 99))}
+        return stats
@@ -0,0 +1,142 @@
+import io
+import os
+import array
+import errno
+import fcntl
+import select
+import serial
+
+from Clock import monotonic
+
+# linux/serial.h - struct serial_struct, flags is the 5th int
+TIOCGSERIAL       = 0x541E
+TIOCSSERIAL       = 0x541F
+ASYNC_LOW_LATENCY = 1 << 13
+
+
+class Transport_Timeout(IOError):
+    pass
+
+
+class SerialTransport( object ):
+    """ Blocking, deadline bound access to the serial line.
+
+        Reads and writes wait on the file descriptor with poll() rather
+        than spinning on inWaiting(), so an idle transaction costs no CPU
+        and never takes longer than its deadline.
+    """
+
+    def __init__(self, port, baud, timeout=5, low_latency=True):
+        self.port = port
+        self.baud = baud
+        self.timeout = timeout
+        # Non-blocking, all waiting is done on the poller
+        self.comline = serial.Serial(self.port, self.baud, timeout=0)
+        self.fd = self.comline.fileno()
+        # readinto() straight from the fd, pyserial's own buffering skipped
+        self.raw = io.FileIO(self.fd, 'r', closefd=False)
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN | select.POLLPRI)
+        self.low_latency = low_latency and self.set_low_latency()
+
+    def set_low_latency(self):
+        """ Ask the tty driver to push received bytes up immediately
+            instead of batching them. Not all drivers (or ptys) support
+            it, returns whether it took.
+        """
+        buf = array.array('i', [0] * 32)
+        try:
+            fcntl.ioctl(self.fd, TIOCGSERIAL, buf)
+            buf[4] |= ASYNC_LOW_LATENCY
+            fcntl.ioctl(self.fd, TIOCSSERIAL, buf)
+        except IOError:
+            return False
+        return True
+
+    def deadline(self, timeout=None):
+        """ Absolute monotonic deadline timeout (or the default) from now """
+        if timeout is None: timeout = self.timeout
+        return monotonic() + timeout
+
+    def flush(self):
+        """ Drop stale input. Output is drained, not discarded, it is
+            only ever whole frames and the last may be a trailing ACK.
+        """
+        self.comline.flush()
+        self.comline.flushInput()
+
+    def _wait(self, events, deadline):
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return False
+        self.poller.modify(self.fd, events)
+        try:
+            ready = self.poller.poll(remaining * 1000.0)
+        except select.error as e:
+            if e.args[0] == errno.EINTR: return True
+            raise
+        for fd, revents in ready:
+            if revents & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                raise IOError("Serial line {0} hung up".format(self.port))
+        return bool(ready)
+
+    def write(self, frame, deadline=None):
+        """ Write a whole frame, normally in a single syscall """
+        if deadline is None: deadline = self.deadline()
+        view = memoryview(frame)
+        while len(view):
+            try:
+                view = view[os.write(self.fd, view):]
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR): raise
+                if not self._wait(select.POLLOUT, deadline):
+                    raise Transport_Timeout("Write timed out on {0}".format(self.port))
+        return len(frame)
+
+    def read(self, size, deadline=None):
+        """ Read exactly size bytes, sleeping in poll() until they arrive
+            or the deadline passes.
+        """
+        if deadline is None: deadline = self.deadline()
+        data = b""
+        while len(data) < size:
+            try:
+                chunk = os.read(self.fd, size - len(data))
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR): raise
+                chunk = None
+            # VMIN=0 reads come back empty rather than EAGAIN
+            if chunk:
+                data += chunk
+                continue
+            if not self._wait(select.POLLIN | select.POLLPRI, deadline):
+                raise Transport_Timeout("Read timed out on {0}, got {1} of {2} bytes"
+                                        .format(self.port, len(data), size))
+        return data
+
+    def readinto(self, buffer, deadline=None):
+        """ Fill buffer (a bytearray or memoryview of one) exactly,
+            read() without allocating
+        """
+        if deadline is None: deadline = self.deadline()
+        view = memoryview(buffer)
+        size = len(view)
+        got = 0
+        while got < size:
+            try:
+                n = self.raw.readinto(view[got:])
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR): raise
+                n = None
+            # None on EAGAIN, 0 from a VMIN=0 read
+            if n:
+                got += n
+                continue
+            if not self._wait(select.POLLIN | select.POLLPRI, deadline):
+                raise Transport_Timeout("Read timed out on {0}, got {1} of {2} bytes"
+                                        .format(self.port, got, size))
+        return size
+
+    def close(self):
+        self.poller.unregister(self.fd)
+        self.comline.close()
@@ -0,0 +1,90 @@
+import mmap
+import struct
+import multiprocessing
+
+
+class SharedState( object ):
+    """ Fixed layout state block in anonymous shared memory.
+
+        Drop-in for the Manager().dict that used to sit between the control
+        loop and the GUI. Create it before forking, both sides then read
+        the same pages directly. Reads never lock, a sequence counter
+        (seqlock) makes them retry if they raced a writer. Writers
+        serialise on a Lock.
+
+        Every field is stored as a double, floats use NaN for None and
+        bools are typed by their initial value.
+    """
+
+    _seq = struct.Struct('Q')
+
+    def __init__(self, fields):
+        """ fields - sequence of (name, initial value) pairs """
+        fields = list(fields)
+        self.names = tuple(name for name, value in fields)
+        self.bools = frozenset(name for name, value in fields if isinstance(value, bool))
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self._body = struct.Struct('{0}d'.format(len(self.names)))
+        self._field = struct.Struct('d')
+        self.buf = mmap.mmap(-1, self._seq.size + self._body.size)
+        self.lock = multiprocessing.Lock()
+        self.update(fields)
+
+    def _offset(self, name):
+        return self._seq.size + self.index[name] * self._field.size
+
+    def _decode(self, name, value):
+        if name in self.bools:
+            return bool(value)
+        if value != value: # NaN
+            return None
+        return value
+
+    def _encode(self, name, value):
+        if value is None:
+            return float('nan')
+        return float(value)
+
+    def __getitem__(self, name):
+        offset = self._offset(name)
+        while True:
+            seq = self._seq.unpack_from(self.buf, 0)[0]
+            if seq & 1: continue # write in progress
+            value = self._field.unpack_from(self.buf, offset)[0]
+            if self._seq.unpack_from(self.buf, 0)[0] == seq:
+                return self._decode(name, value)
+
+    def __setitem__(self, name, value):
+        self.update({name: value})
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get(self, name, default=None):
+        return self[name] if name in self.index else default
+
+    def keys(self):
+        return list(self.names)
+
+    def update(self, *args, **kwargs):
+        """ Write several fields as one consistent change """
+        values = dict(*args, **kwargs)
+        offsets = [(self._offset(name), self._encode(name, value))
+                   for name, value in values.items()]
+        with self.lock:
+            seq = self._seq.unpack_from(self.buf, 0)[0]
+            self._seq.pack_into(self.buf, 0, seq + 1)
+            for offset, value in offsets:
+                self._field.pack_into(self.buf, offset, value)
+            self._seq.pack_into(self.buf, 0, seq + 2)
+
+    def snapshot(self):
+        """ All fields as a plain dict, from a single point in time """
+        while True:
+            seq = self._seq.unpack_from(self.buf, 0)[0]
+            if seq & 1: continue
+            values = self._body.unpack_from(self.buf, self._seq.size)
+            if self._seq.unpack_from(self.buf, 0)[0] == seq:
+                break
+        return dict((name, self._decode(name, value))
+                    for name, value in zip(self.names, values))
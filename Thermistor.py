@@ -0,0 +1,92 @@
+""" Host side thermistor conversion for firmware running in raw ADC mode.
+
+    The board reads the bath thermistor through a divider (thermistor to
+    ground, series resistor to the rail) and, in raw mode, reports the sum
+    of its last N 10 bit readings instead of a temperature. Every possible
+    sum maps to one temperature, so the whole curve is computed once into
+    a lookup table and decoding is an index, scalar or array.
+"""
+import math
+
+import numpy
+
+ADC_MAX = 1023
+KELVIN = 273.15
+
+
+class Thermistor( object ):
+    """ beta model (beta, r0 at t0) unless Steinhart-Hart coefficients
+        a, b, c are given. offset is a calibration correction added to
+        every reading, degrees C.
+    """
+
+    def __init__(self, samples=16, series=10000.0, beta=3900.0, r0=10000.0, t0=25.0,
+                 a=None, b=None, c=None, offset=0.0):
+        if not 0 < samples * ADC_MAX <= 0xFFFF:
+            raise ValueError("{0} samples overflow the 16 bit field".format(samples))
+        self.samples = samples
+        self.series = series
+        self.beta = beta
+        self.r0 = r0
+        self.t0 = t0
+        self.coefficients = None if a is None else (a, b, c)
+        self.offset = offset
+        self.table = self.celsius_of_counts(numpy.arange(samples * ADC_MAX + 1))
+
+    @classmethod
+    def from_config(cls, config, section='Thermistor'):
+        """ Thermistor for a config section, None when it is missing or its
+            Raw_Samples is 0 (conversion stays on the board)
+        """
+        if not config.has_section(section):
+            return None
+        get = lambda option, default=None: (config.getfloat(section, option)
+                                            if config.has_option(section, option)
+                                            else default)
+        samples = int(get('Raw_Samples', 16))
+        if not samples:
+            return None
+        return cls(samples, get('Series', 10000.0), get('Beta', 3900.0),
+                   get('R0', 10000.0), get('T0', 25.0),
+                   get('A'), get('B'), get('C'), get('Offset', 0.0))
+
+    def resistance(self, counts):
+        """ Thermistor ohms for a sum of samples readings """
+        adc = numpy.asarray(counts, dtype=float) / self.samples
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return self.series * adc / (ADC_MAX - adc)
+
+    def celsius_of_resistance(self, ohms):
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ln_r = numpy.log(numpy.asarray(ohms, dtype=float))
+            if self.coefficients is None:
+                inverse = 1.0 / (self.t0 + KELVIN) + (ln_r - math.log(self.r0)) / self.beta
+            else:
+                a, b, c = self.coefficients
+                inverse = a + b * ln_r + c * ln_r ** 3
+            return 1.0 / inverse - KELVIN + self.offset
+
+    def celsius_of_counts(self, counts):
+        """ Unclipped conversion, NaN at the rails (open or shorted) """
+        counts = numpy.asarray(counts)
+        t = self.celsius_of_resistance(self.resistance(counts))
+        rail = (counts <= 0) | (counts >= self.samples * ADC_MAX)
+        return numpy.where(rail | ~numpy.isfinite(t), numpy.nan, t)
+
+    def celsius(self, counts):
+        """ Table lookup, counts a single sum or an array of them """
+        return self.table[numpy.clip(counts, 0, len(self.table) - 1)]
+
+    def counts(self, celsius):
+        """ Inverse, the raw sum the board would report at celsius. Used
+            by the emulator.
+        """
+        t = celsius - self.offset + KELVIN
+        if self.coefficients is None:
+            ohms = self.r0 * math.exp(self.beta * (1.0 / t - 1.0 / (self.t0 + KELVIN)))
+        else:
+            # The table is monotonic, search it rather than invert the cubic
+            index = numpy.searchsorted(-self.table[1:-1], -celsius)
+            return int(index) + 1
+        adc = ADC_MAX * ohms / (ohms + self.series)
+        return int(round(adc * self.samples))
@@ -0,0 +1,164 @@
+""" Opt-in timing spans in the Chrome trace event format.
+
+    with Trace.span('get_temp'):
+        ...
+
+    costs one global check while tracing is off. Once enable(path) is
+    called every span becomes a complete ('X') event, timestamped on the
+    monotonic clock so the control and GUI processes line up, and is
+    appended to path a batch at a time (at least once a second). The
+    file is a JSON array left open at the end, which chrome://tracing
+    and Perfetto load as it is, so a multi-hour run can be opened while
+    it is still being written or after a crash.
+
+    Each process enables tracing for itself, they may share a file.
+"""
+import os
+import json
+import errno
+import atexit
+import functools
+import threading
+
+from Clock import monotonic
+
+FLUSH_EVENTS = 512
+FLUSH_SECONDS = 1.0
+
+
+class _NullSpan( object ):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL = _NullSpan()
+
+
+class _Span( object ):
+
+    def __init__(self, writer, name, cat, args):
+        self.writer = writer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        end = monotonic()
+        self.writer.add(self.name, self.cat, self.start, end, self.args)
+
+
+class TraceWriter( object ):
+    """ Buffers events and appends them to path in whole lines """
+
+    def __init__(self, path):
+        self.path = path
+        # Only the process that creates the file starts the array, the
+        # GUI and control processes enable tracing within milliseconds
+        # of each other
+        try:
+            self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0644)
+            os.write(self.fd, '[\n')
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        self.pid = os.getpid()
+        self.events = []
+        self.threads = set()
+        self.flushed = monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, name, cat, start, end, args):
+        thread = threading.current_thread()
+        tid = thread.ident
+        event = {'ph': 'X', 'name': name, 'cat': cat, 'pid': self.pid, 'tid': tid,
+                 'ts': start * 1e6, 'dur': (end - start) * 1e6}
+        if args:
+            event['args'] = args
+        # Every bath's loop thread adds spans
+        with self.lock:
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self.events.append({'ph': 'M', 'name': 'thread_name', 'pid': self.pid,
+                                    'tid': tid, 'args': {'name': thread.name}})
+            self.events.append(event)
+            due = len(self.events) >= FLUSH_EVENTS or end - self.flushed >= FLUSH_SECONDS
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            events, self.events = self.events, []
+            self.flushed = monotonic()
+            if events and self.fd is not None:
+                os.write(self.fd, ''.join(json.dumps(e) + ',\n' for e in events))
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            fd, self.fd = self.fd, None
+        if fd is not None:
+            os.close(fd)
+
+
+_writer = None
+
+
+def enable(path, process_name=None):
+    """ Start tracing this process to path """
+    global _writer
+    disable()
+    writer = TraceWriter(path)
+    if process_name is not None:
+        writer.events.append({'ph': 'M', 'name': 'process_name', 'pid': writer.pid,
+                              'args': {'name': process_name}})
+    # Spans only see the writer once it is complete
+    _writer = writer
+    return _writer
+
+
+def disable():
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        writer.close()
+
+
+def enabled():
+    return _writer is not None
+
+
+def from_config(config, process_name=None, section='Trace'):
+    """ enable() on the section's Path when set """
+    if config.has_option(section, 'Path') and config.get(section, 'Path'):
+        return enable(config.get(section, 'Path'), process_name)
+
+
+def span(name, cat='pybath', **args):
+    """ Context manager timing its block, a no-op unless enabled """
+    writer = _writer
+    if writer is None:
+        return _NULL
+    return _Span(writer, name, cat, args)
+
+
+def traced(name, cat='pybath'):
+    """ Decorator, a span around every call """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, cat):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+atexit.register(disable)
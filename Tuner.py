@@ -0,0 +1,226 @@
+""" Offline P/I/D search against the simulated bath.
+
+    Every candidate runs the real ControlLoop (staged gains and all)
+    against a BathPlant on a stepped virtual clock, so hours of heating
+    take milliseconds. Candidates are spread over a process pool and
+    ranked by
+
+        cost = settling time + overshoot_weight * (overshoot + final error)
+                             + energy_weight * energy
+
+    python Tuner.py --target 37 --p 0.1:2:8 --i 0:1:6 --d 0:2:6
+    python Tuner.py --target 37 --random 2000 --p 0.1:2 --i 0:1 --d 0:2
+    python Tuner.py --target 37 --compare-modes
+
+--compare-modes runs the configured P/I/D once in every control mode
+instead of searching.
+"""
+import json
+import random
+import argparse
+import itertools
+import multiprocessing
+from ConfigParser import SafeConfigParser
+
+import numpy
+
+from Clock import VirtualClock
+from ControlLoop import ControlLoop, tuning_state, control_mode
+from Kalman import Kalman
+from Physics import resistance_to_watts
+from Plant import BathPlant, SimulatedController
+from SharedState import SharedState
+
+
+def response_metrics(times, temps, target, band):
+    """ Time to first reach target, settling time into +/- band and
+        overshoot of a step response. Times are None if never reached.
+    """
+    times = numpy.asarray(times)
+    temps = numpy.asarray(temps)
+    reached = numpy.nonzero(temps >= target - band)[0]
+    time_to_setpoint = float(times[reached[0]]) if len(reached) else None
+    outside = numpy.nonzero(numpy.abs(temps - target) > band)[0]
+    if not len(outside):
+        settling_time = float(times[0])
+    elif outside[-1] + 1 < len(times):
+        settling_time = float(times[outside[-1] + 1])
+    else:
+        settling_time = None
+    overshoot = max(0.0, float(temps.max()) - target) if len(temps) else 0.0
+    return time_to_setpoint, settling_time, overshoot
+
+
+def simulate(tuning, gains, target, duration, period=10.0, band=0.2,
+             plant_options=None, loop_options=None, filter_options=None):
+    """ Run one closed loop heat up from cold, returns its metrics.
+        filter_options, when given, puts a Kalman of them on the readings.
+    """
+    clock = VirtualClock(None)
+    state = SharedState(tuning)
+    p, i, d = gains
+    state.update(p=p, i=i, d=d, target=target, start=True)
+    s = state.snapshot()
+    plant = BathPlant(clock, s['mass'], s['heatCapacity'], s['emissivity'], s['area'],
+                      resistance_to_watts(s['resistance'], s['voltage']),
+                      **(plant_options or {}))
+    loop = ControlLoop(SimulatedController(plant), state, period,
+                       clock=clock, sleep=clock.sleep, verbose=False,
+                       estimator=filter_options and Kalman(**filter_options),
+                       **(loop_options or {}))
+    loop.get_temp()
+    loop.reset()
+    loop.scheduler.start()
+    times, temps = [], []
+    while clock() < duration:
+        loop.scheduler.wait()
+        plant.advance()
+        times.append(clock())
+        temps.append(plant.bath_temp)
+        loop.cycle()
+        loop.get_temp()
+        loop.scheduler.done()
+    time_to_setpoint, settling_time, overshoot = response_metrics(times, temps, target, band)
+    return {'p': p, 'i': i, 'd': d,
+            'time_to_setpoint': time_to_setpoint,
+            'settling_time': settling_time,
+            'overshoot': overshoot,
+            'final_error': abs(temps[-1] - target),
+            'energy': plant.energy_used}
+
+
+def cost(result, duration, overshoot_weight, energy_weight):
+    settling = result['settling_time']
+    # Never settled is worse than settling at the very end
+    if settling is None: settling = 2 * duration
+    error = result['overshoot'] + result['final_error']
+    return settling + overshoot_weight * error + energy_weight * result['energy']
+
+
+def compare_modes(tuning, gains, options, modes=(ControlLoop.STAGED, ControlLoop.FEEDFORWARD)):
+    """ The same gains simulated under each control mode, mode -> metrics """
+    results = {}
+    for mode in modes:
+        loop_options = dict(options.get('loop_options') or {}, mode=mode)
+        results[mode] = simulate(tuning, gains, **dict(options, loop_options=loop_options))
+    return results
+
+
+def _run(job):
+    tuning, gains, options = job
+    return simulate(tuning, gains, **options)
+
+
+def parse_range(text):
+    """ 'value', 'start:stop' or 'start:stop:count' -> (start, stop, count) """
+    parts = [float(x) for x in text.split(':')]
+    if len(parts) == 1:
+        return parts[0], parts[0], 1
+    if len(parts) == 2:
+        return parts[0], parts[1], 5
+    return parts[0], parts[1], int(parts[2])
+
+
+def candidates(ranges, samples=None, seed=None):
+    """ Full grid over the (start, stop, count) ranges, or samples
+        uniform random draws from them
+    """
+    if samples:
+        rng = random.Random(seed)
+        return [tuple(rng.uniform(start, stop) for start, stop, count in ranges)
+                for n in range(samples)]
+    axes = [numpy.linspace(start, stop, count) for start, stop, count in ranges]
+    return [tuple(float(x) for x in gains) for gains in itertools.product(*axes)]
+
+
+def search(tuning, gains, options, processes=None, overshoot_weight=600.0,
+           energy_weight=0.0):
+    """ Simulate every candidate over a process pool, best first """
+    pool = multiprocessing.Pool(processes)
+    try:
+        jobs = [(tuning, g, options) for g in gains]
+        results = list(pool.imap_unordered(_run, jobs, chunksize=max(1, len(jobs) // 64)))
+    finally:
+        pool.close()
+        pool.join()
+    for r in results:
+        r['cost'] = cost(r, options['duration'], overshoot_weight, energy_weight)
+    return sorted(results, key=lambda r: r['cost'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='config.conf')
+    parser.add_argument('--section', default='Tuning')
+    parser.add_argument('--target', type=float, required=True)
+    parser.add_argument('--env-temp', type=float, default=21.0)
+    parser.add_argument('--duration', type=float, default=4 * 3600,
+                        help="simulated seconds per run")
+    parser.add_argument('--band', type=float, default=0.2,
+                        help="settled when within this many degrees")
+    parser.add_argument('--p', default='0.1:2:5')
+    parser.add_argument('--i', default='0:1:5')
+    parser.add_argument('--d', default='0:2:5')
+    parser.add_argument('--random', type=int, default=0,
+                        help="random samples instead of the full grid")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--sensor-tau', type=float, default=20.0)
+    parser.add_argument('--noise', type=float, default=0.0)
+    parser.add_argument('--filter', action='store_true',
+                        help="Kalman filter the readings, noise settings from [Filter]")
+    parser.add_argument('--overshoot-weight', type=float, default=600.0,
+                        help="seconds of settling one degree of overshoot costs")
+    parser.add_argument('--energy-weight', type=float, default=0.0,
+                        help="seconds of settling one joule costs")
+    parser.add_argument('--mode', default=None,
+                        help="control mode to search under, default the config's")
+    parser.add_argument('--compare-modes', action='store_true',
+                        help="time to setpoint and overshoot of each mode")
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--json', help="write every result here")
+    args = parser.parse_args()
+
+    config = SafeConfigParser()
+    config.read(args.config)
+    tuning = tuning_state(config, args.section)
+    options = {'target': args.target, 'duration': args.duration, 'band': args.band,
+               'plant_options': {'env_temp': args.env_temp, 'sensor_tau': args.sensor_tau,
+                                 'noise': args.noise, 'seed': args.seed},
+               'loop_options': {'mode': args.mode or control_mode(config, args.section),
+                                'sensor_lag': args.sensor_tau}}
+    if args.filter:
+        get = lambda option, default: (config.getfloat('Filter', option)
+                                       if config.has_option('Filter', option) else default)
+        options['filter_options'] = {'measurement_noise': get('Measurement_Noise', 0.05),
+                                     'process_noise': get('Process_Noise', 0.001),
+                                     'direct_noise': get('Direct_Noise', 0.2),
+                                     'sensor_lag': args.sensor_tau}
+    fmt = lambda v: '-' if v is None else '{0:.0f}'.format(v)
+    if args.compare_modes:
+        state = dict(tuning)
+        results = compare_modes(tuning, (state['p'], state['i'], state['d']), options)
+        print "{0:>12} {1:>10} {2:>10} {3:>10} {4:>10} {5:>12}".format(
+              'mode', 'reach s', 'settle s', 'overshoot', 'error', 'energy kJ')
+        for mode, r in sorted(results.items()):
+            print "{0:>12} {1:>10} {2:>10} {3:10.2f} {4:10.2f} {5:12.1f}".format(
+                  mode, fmt(r['time_to_setpoint']), fmt(r['settling_time']),
+                  r['overshoot'], r['final_error'], r['energy'] / 1000.0)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=1)
+    else:
+        gains = candidates([parse_range(args.p), parse_range(args.i), parse_range(args.d)],
+                           args.random, args.seed)
+        print "Simulating {0} candidates...".format(len(gains))
+        results = search(tuning, gains, options, args.processes,
+                         args.overshoot_weight, args.energy_weight)
+        print "{0:>8} {1:>8} {2:>8} {3:>10} {4:>10} {5:>10} {6:>12}".format(
+              'P', 'I', 'D', 'reach s', 'settle s', 'overshoot', 'energy kJ')
+        for r in results[:args.top]:
+            print "{0:8.4f} {1:8.4f} {2:8.4f} {3:>10} {4:>10} {5:10.2f} {6:12.1f}".format(
+                  r['p'], r['i'], r['d'], fmt(r['time_to_setpoint']), fmt(r['settling_time']),
+                  r['overshoot'], r['energy'] / 1000.0)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=1)
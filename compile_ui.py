@@ -0,0 +1,42 @@
+""" Precompile the Designer form so the GUI doesn't parse XML at startup.
+
+    python compile_ui.py
+
+    Writes second_ui.py next to second.ui, rerun it after editing the
+    form. pyBath.py falls back to loading second.ui at runtime when the
+    compiled module is missing or older than the form.
+
+    The plot widget (qtgr's InteractiveGRWidget) is swapped for a plain
+    QWidget placeholder, MainWindow fills it in once there is something
+    to plot, which keeps gr out of the startup imports. The runtime
+    fallback loads the same placeholder form.
+"""
+import os
+import re
+from StringIO import StringIO
+from PyQt4 import uic
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+
+def placeholder_form(source):
+    """ The form with the plot widget a plain QWidget, as a file for
+        uic, so neither compiling nor loading it imports qtgr
+    """
+    with open(source) as f:
+        text = f.read()
+    text = re.sub(r'\s*<customwidgets>.*?</customwidgets>', '', text, flags=re.S)
+    form = StringIO(text.replace('class="InteractiveGRWidget"', 'class="QWidget"'))
+    # uic names the source in the module it writes
+    form.name = source
+    return form
+
+
+def compile_ui(source, target):
+    with open(target, 'w') as f:
+        uic.compileUi(placeholder_form(source), f)
+
+
+if __name__ == "__main__":
+    compile_ui(os.path.join(HERE, 'second.ui'), os.path.join(HERE, 'second_ui.py'))
+    print "Wrote second_ui.py"
@@ -3,30 +3,61 @@ import sys
 import os
 import time
 import logging
+import threading
 # third party
 from PyQt4 import QtCore
 from PyQt4 import QtGui
 from PyQt4 import uic
-# local library
-import gr # TESTING shell
-import qtgr
-from qtgr.backend import QtCore, QtGui
-from qtgr.events import GUIConnector, MouseEvent, PickEvent, LegendEvent
-from gr.pygr import Plot, PlotAxes, PlotCurve, ErrorBar
+# local library, gr and qtgr are imported once there is a plot to show
+from Clock import monotonic
+from PlotHistory import PlotHistory
+import Trace
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+# P/I/D spin box limit, AutoTune.py's gains run to tens of thousands
+GAIN_MAXIMUM = 1000000.0
+
+
+def load_form(window):
+    """ Build the Designer form onto window, from the module compile_ui.py
+        makes when it is current, else by parsing second.ui. Either way
+        the plot is a placeholder until _build_plot(), qtgr isn't loaded.
+    """
+    source = os.path.join(HERE, "second.ui")
+    compiled = os.path.join(HERE, "second_ui.py")
+    if os.path.exists(compiled) and os.path.getmtime(compiled) >= os.path.getmtime(source):
+        from second_ui import Ui_pyBath
+        Ui_pyBath().setupUi(window)
+    else:
+        from compile_ui import placeholder_form
+        uic.loadUi(placeholder_form(source), window)
 
 
 
 class MainWindow(QtGui.QMainWindow):
 
-    def __init__(self, *args, **kwargs):
-        while not shared_memory['data_fresh']:
-            pass
+    hardwareReady = QtCore.pyqtSignal()
+
+    def __init__(self, ready=None, started=None, sample_interval=5000,
+                 refresh_interval=1000, *args, **kwargs):
+        """ ready - Event set once the hardware has sent good data, the
+                    plot is built then. started - monotonic() time the
+                    process started, for the startup timings.
+            sample_interval - ms between reads of the shared state
+            refresh_interval - ms between plot redraws, skipped when no
+                               new samples came in
+        """
         super(MainWindow, self).__init__(*args, **kwargs)
-        uic.loadUi(os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                "second.ui"), self) 
+        self.sample_interval = sample_interval
+        self.refresh_interval = refresh_interval
+        load_form(self)
+        self.started = monotonic() if started is None else started
+        self.startup = {'form': monotonic() - self.started}
         self.monitor_mode = False
-        self.state = 'Connecting...'
+        self.state = 'Waiting for hardware...'
         self.prev_time = time.time()
+        self._plot = None
 
         self._heat_capacity_spin.valueChanged.connect(self.updateHeatCapacity)
         self._heat_capacity_spin.setDecimals(4)
@@ -60,17 +91,17 @@ class MainWindow(QtGui.QMainWindow):
 
         self._p_spin.valueChanged.connect(self.updateP)
         self._p_spin.setDecimals(4)
-        self._p_spin.setMaximum(2.00) 
+        self._p_spin.setMaximum(GAIN_MAXIMUM)
         self._p_spin.setSingleStep(0.0001)
 
         self._i_spin.valueChanged.connect(self.updateI)
         self._i_spin.setDecimals(4)
-        self._i_spin.setMaximum(2.00) 
+        self._i_spin.setMaximum(GAIN_MAXIMUM)
         self._i_spin.setSingleStep(0.0001)
 
         self._d_spin.valueChanged.connect(self.updateD)
         self._d_spin.setDecimals(4)
-        self._d_spin.setMaximum(2.00) 
+        self._d_spin.setMaximum(GAIN_MAXIMUM)
         self._d_spin.setSingleStep(0.0001)
 
         self._target_spin.valueChanged.connect(self.updateTarget)
@@ -112,6 +143,51 @@ class MainWindow(QtGui.QMainWindow):
         # self._ambient_lcd.display(0.0)
         # self._bath_lcd.display(0.0)
 
+        # Bounded history, the curves only ever get a decimated view of it
+        self.history = PlotHistory()
+
+        # No spinning on data_fresh, the form shows at once and the plot
+        # follows when the control process signals the first good reading
+        self.hardwareReady.connect(self._hardware_ready)
+        if ready is None:
+            self.hardwareReady.emit()
+        else:
+            waiter = threading.Thread(target=lambda: (ready.wait(), self.hardwareReady.emit()))
+            waiter.daemon = True
+            waiter.start()
+
+    def _hardware_ready(self):
+        self.startup['hardware'] = monotonic() - self.started
+        self._build_plot()
+        self.startup['plot'] = monotonic() - self.started
+        print "Startup: form {form:.3f}s, shown {shown:.3f}s, hardware {hardware:.3f}s, " \
+              "plot {plot:.3f}s".format(**dict({'shown': float('nan')}, **self.startup))
+        self.updateData()
+        # Acquisition and drawing tick independently
+        self.sample_timer = QtCore.QTimer(self)
+        self.sample_timer.timeout.connect(self.updateData)
+        self.sample_timer.start(self.sample_interval)
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.timeout.connect(self.render)
+        self.refresh_timer.start(self.refresh_interval)
+
+    def showEvent(self, event):
+        super(MainWindow, self).showEvent(event)
+        self.startup.setdefault('shown', monotonic() - self.started)
+
+    def _build_plot(self):
+        import gr
+        from gr.pygr import Plot, PlotAxes, PlotCurve
+        from qtgr import InteractiveGRWidget
+        # The compiled form has a placeholder where the plot widget goes
+        if not isinstance(self._stage, InteractiveGRWidget):
+            holder = self._stage
+            self._stage = InteractiveGRWidget(holder)
+            layout = QtGui.QVBoxLayout(holder)
+            layout.setContentsMargins(0, 0, 0, 0)
+            layout.addWidget(self._stage)
+
+        self.history.add(1.0, shared_memory['env_temp'], shared_memory['bath_temp'])
         x = [1.0]
         y = [shared_memory['bath_temp']]
         xe = [1.0]
@@ -134,42 +210,60 @@ class MainWindow(QtGui.QMainWindow):
         self._plot.xlabel = "Seconds"
         self._plot.ylabel = "Celsius"
         self._plot.setLegend(True)
-        self._plot.autoscale = PlotAxes.SCALE_X | PlotAxes.SCALE_Y
+        # Axes hold their range until the data leaves it, rather than
+        # rescaling on every draw
+        self._plot.autoscale = 0
+        self._axes = axes
+        self._draw()
         self._stage.addPlot(self._plot)
 
-        timer = QtCore.QTimer(self)
-        timer.timeout.connect(self.updateData)
-        timer.start(5000)
-
     def _reset_curves(self):
-        self.bath_curve.x = [0.0]
-        self.env_curve.x  = [0.0]
-        self.bath_curve.y = [shared_memory['bath_temp']]
-        self.env_curve.y  = [shared_memory['env_temp']]
-
+        if self._plot is None:
+            return
+        # Redrawn from scratch on the next refresh tick
+        self.history.reset(0.0, shared_memory['env_temp'], shared_memory['bath_temp'])
+
+    def _draw(self):
+        """ Bring the curves up to date with the history, False when
+            there was nothing new
+        """
+        if not self.history.refresh(self._stage.width()):
+            return False
+        self.env_curve.x, self.env_curve.y = self.history.env
+        self.bath_curve.x, self.bath_curve.y = self.history.bath
+        self._axes.setWindow(*self.history.window)
+        return True
+
+    @Trace.traced('render')
+    def render(self):
+        """ Refresh tick, redraw the plot only if there is new data """
+        if self._plot is not None and self._draw():
+            self._stage.update()
+
+    @Trace.traced('updateData')
     def updateData(self):
-        
-        if shared_memory['data_fresh']:
+        # One read of the state, one round trip when it is a daemon's
+        try:
+            s = shared_memory.snapshot()
+        except IOError:
+            s = {'data_fresh': False}
+        if s['data_fresh']:
             t = time.time()
             if self.state != 'Connected!':
                 self.state = 'Connected!'
                 self._state_out_label.setText(self.state)
-            self._env_label.setText(str(shared_memory['env_temp']))
-            self._bath_label_2.setText(str(shared_memory['bath_temp']))
-
-            if self.monitor_mode or shared_memory['start']:
-                self.env_curve.x.append(t - self.prev_time)#self.env_curve.x[-1]+5)
-                self.bath_curve.x.append(t - self.prev_time)#self.bath_curve.x[-1]+5)
-                self.env_curve.y.append(shared_memory['env_temp'])
-                self.bath_curve.y.append(shared_memory['bath_temp'])
-        else:
+            self._env_label.setText(str(s['env_temp']))
+            self._bath_label_2.setText(str(s['bath_temp']))
+
+            if self.monitor_mode or s['start']:
+                # Drawn on the next refresh tick
+                self.history.add(t - self.prev_time, s['env_temp'], s['bath_temp'])
+        elif self.state != 'Connecting...':
             self.state = 'Connecting...'
             self._state_out_label.setText(self.state)
             self._env_label.setText('0.0')
             self._bath_label_2.setText('0.0')
 
-        self.update() 
-
 
     def updateHeatCapacity(self):
       shared_memory['heatCapacity'] = float(self._heat_capacity_spin.cleanText())
@@ -256,20 +350,18 @@ class MainWindow(QtGui.QMainWindow):
 
 
 
-def get_temp( send=False, on_time=0 ):
-    if send: controller.set_element_time(on_time)
-    # If there is a problem with packet
-    t = controller.get_temperatures()
-    if t is None or t[0] == 0.0 or t[1] == 0.0:
-        shared_memory['data_fresh'] = False
-        return
-    shared_memory['env_temp']   = t[0]
-    shared_memory['bath_temp']  = t[1]
-    shared_memory['data_fresh'] = True
-
-def window_main(*args):
-    app = QtGui.QApplication(sys.argv)
-    mainWin = MainWindow()
+def window_main(argv, state, ready=None, started=None, sample_interval=5000,
+                refresh_interval=1000, trace=None):
+    """ state - the bath's SharedState, or a DaemonClient
+        trace - file to trace the GUI's spans to, see Trace.py
+    """
+    if trace:
+        Trace.enable(trace, 'gui')
+    global shared_memory
+    shared_memory = state
+    started = monotonic() if started is None else started
+    app = QtGui.QApplication(argv)
+    mainWin = MainWindow(ready, started, sample_interval, refresh_interval)
     mainWin.show()
     sys.exit(app.exec_())
 
@@ -278,139 +370,65 @@ def window_main(*args):
 
 if __name__ == "__main__":
 
-    import PID
-    from BathController import BathController
-    from multiprocessing import Process, Manager, Lock
     from ConfigParser import SafeConfigParser
 
-    def resistance_to_watts(resistance, voltage):
-        """ Calculate element wattage from resitance and voltage """
-        return (voltage**2)/resistance
-
-    def joules_to_watt_seconds(joules, element_wattage):
-        """ Calculate element time from energy in joules """
-        return float(joules/element_wattage)
-
-    def temperature_to_joules(temp_obj, temp_amb, mass_kg, heat_capacity):
-        """ Calculate energy contained within the bath medium """
-        # 4.184 is cal -> joule, specific heat is cal/g/c, we want joule/g/k
-        return float((heat_capacity * (mass_kg*1000) * (temp_obj - temp_amb))/4.184)
-
-    def boltzmann_loss(emissivity, area, temp_obj, temp_amb):
-        """ Calculate the energy radiated at a given temperature """
-        temp_amb += 273.15
-        temp_obj += 273.15
-        boltzmann_const = 5.670373e-8# W * m^-2 * K^-4
-        a = area*((temp_obj**4) - (temp_amb**4))# A(T^4 - Tc^4)
-        return emissivity*boltzmann_const*a
-
-
-
-    manager = Manager()
     config = SafeConfigParser()
     config.read('config.conf')
-    shared_memory = manager.dict({
-                                  'env_temp':None,
-                                  'bath_temp':None,
-                                  'heatCapacity':float(config.get('Tuning', 'Heat_Capacity')),
-                                  'mass':float(config.get('Tuning', 'Mass')),
-                                  'emissivity':float(config.get('Tuning', 'Emissivity')),
-                                  'area':float(config.get('Tuning', 'Area')),
-                                  'resistance':float(config.get('Tuning', 'Resistance')),
-                                  'voltage':float(config.get('Tuning', 'Voltage')),
-                                  'p':float(config.get('Tuning', 'P')), 
-                                  'i':float(config.get('Tuning', 'I')), 
-                                  'd':float(config.get('Tuning', 'D')),
-                                  'target':None,
-                                  'start':False,
-                                  'data_fresh':False
-                                  })
+    trace = config.get('Trace', 'Path') if config.has_option('Trace', 'Path') else None
+
+    # pyBath.py --connect [socket], just the window on a running Daemon.py
+    if '--connect' in sys.argv:
+        from Daemon import DaemonClient, SOCKET
+        i = sys.argv.index('--connect')
+        path = sys.argv[i + 1] if len(sys.argv) > i + 1 else (
+               config.get('Daemon', 'Socket') if config.has_option('Daemon', 'Socket')
+               else SOCKET)
+        client = DaemonClient(path)
+        window_main(sys.argv, client, client, trace=trace)
 
+    from BathController import BathController
+    import Clock
+    from ControlLoop import ControlLoop, tuning_state, control_mode
+    from Recorder import Recorder
+    from Thermistor import Thermistor
+    from Kalman import Kalman
+    from PubSub import Publisher
+    import Metrics
+    from multiprocessing import Process, Event
+    from SharedState import SharedState
+
+    # Lives in shared pages, inherited by the GUI process
+    shared_memory = SharedState(tuning_state(config))
+
+    # GUI first, it shows while the board resets and waits on this
+    hardware_ready = Event()
+    display = lambda option, default: (config.getint('Display', option)
+                                       if config.has_option('Display', option) else default)
+    window_thread = Process(target = window_main,
+                            args = (sys.argv, shared_memory, hardware_ready, monotonic(),
+                                    display('Sample_Interval', 5000),
+                                    display('Refresh_Interval', 1000),
+                                    trace))
+    window_thread.daemon = True
+    window_thread.start()
+
+    Metrics.serve_from_config(config)
+    Trace.from_config(config, 'control')
     controller = BathController(config.get('Connection', 'Port'), 
-                                config.get('Connection', 'Baud'))
+                                config.get('Connection', 'Baud'),
+                                thermistor=Thermistor.from_config(config))
+    loop = ControlLoop(controller, shared_memory, mode=control_mode(config),
+                       recorder=Recorder.from_config(config), ready=hardware_ready,
+                       estimator=Kalman.from_config(config),
+                       publish=getattr(Publisher.from_config(config), 'publish', None),
+                       clock=Clock.from_config(config))
     time.sleep(3)
     print "\rLift off!"
-    get_temp()
-    # Start main window thread
-    window_thread = Process(target = window_main, args = (sys.argv, shared_memory))
-    window_thread.daemon = True
-    window_thread.start()
-    # Initialise PID object
-    pid = PID.control(shared_memory['p']/10000.0, shared_memory['i']/10000.0, shared_memory['d']/10000.0)
+    loop.get_temp()
+    # Firmware pushes samples, get_temp() reads them from the ring
+    if config.has_option('Connection', 'Stream_Period'):
+        stream_period = config.getint('Connection', 'Stream_Period')
+        if stream_period > 0 and controller.features & controller.feature_stream:
+            controller.start_streaming(stream_period)
     # Whilst the UI is open 
-    while window_thread.is_alive():
-        # Kick over 
-        get_temp()
-        #get_temp()
-        if shared_memory['start'] and shared_memory['data_fresh']:
-            cycleStart = time.time()
-            dist = None
-            target_reached = False
-            while shared_memory['start'] and window_thread.is_alive():
-                cycleStart = time.time()
-                To = shared_memory['target']
-                Ta = shared_memory['env_temp']
-                Tb = shared_memory['bath_temp']
-                m  = shared_memory['mass']
-                h  = shared_memory['heatCapacity']
-                e  = shared_memory['emissivity']
-                a  = shared_memory['area']
-                w  = resistance_to_watts(shared_memory['resistance'], shared_memory['voltage'])
-                if Tb >= To: target_reached = True
-                # Calculate desired energy within medium
-                set_point  = temperature_to_joules(To, Ta, m, h) 
-                # print "Set point is {0} Joules".format(set_point)
-                # Add boltzmann radiated loss for that moment
-                #set_point += boltzmann_loss(e, a, To, Ta)
-                # Assess the current energy within medium
-                current_energy = temperature_to_joules(Tb, Ta, m, h)
-                print "\nCurrent stored energy is {0} Joules".format(current_energy)
-                bltz = boltzmann_loss(e,a, Tb, Ta)
-                # Add boltzamn
-                energy_deficit = set_point - current_energy #+ bltz
-                # First loop? save total error for adaptive tuning
-                if dist is None: dist = energy_deficit
-                print "Energy deficit is {0} Joules".format(set_point - current_energy)#+ bltz)
-                if energy_deficit > 0:
-                    # Adaptive tuning
-                    # Below 33% and more than 20Kj, agressive tuning
-                    # if energy_deficit >= (dist/3)*2 and energy_deficit >= 20000:
-                    #     print 'Mode: Agrressive '
-                    #     pid.setKp(shared_memory['p'] / 100.00)   
-                    #     pid.setKi(shared_memory['i'] / 100.00)  
-                    #     pid.setKd(shared_memory['d'] / 100.00)
-                    # Within 25%, use a more conservative tuning
-                    if energy_deficit <= (dist/10):
-                        print 'Mode: Conservative '
-                        pid.setKp(shared_memory['p'] / 20000.00)   
-                        pid.setKi(shared_memory['i'] / 20000.00)  
-                        pid.setKd(shared_memory['d'] / 20000.00)
-                    # Within 25%, use a more conservative tuning
-                    elif energy_deficit <= (dist/4):
-                        print 'Mode: Conservative '
-                        pid.setKp(shared_memory['p'] / 10000.00)   
-                        pid.setKi(shared_memory['i'] / 10000.00)  
-                        pid.setKd(shared_memory['d'] / 10000.00)
-                    # Else normal tuning       
-                    else:
-                        print 'Mode: Normal '
-                        pid.setKp(shared_memory['p'] / 1000.00)   
-                        pid.setKi(shared_memory['i'] / 1000.00)  
-                        pid.setKd(shared_memory['d'] / 1000.00)
-                    # send the PID controller set_energy - stored energy (error)
-                    energy_output = pid.genOut(set_point - current_energy)
-                    # pid returns energy to put in, convert to watt seconds
-                    element_time = joules_to_watt_seconds(energy_output, w)
-                    print "PID wants {0} Joules".format(energy_output)
-                    if element_time > 0.0 and element_time < 10.0: 
-                        print 'Element time   = ', element_time
-                        get_temp(send=True, on_time=int(element_time*1000))
-                    elif element_time > 10.0:
-                        print 'Element time   = 10.0 [CLAMPED]'
-                        get_temp(send=True, on_time=10000)
-                # Update temps
-                get_temp()
-                # dt
-                time.sleep(10 - (time.time()-cycleStart))
-        else:
-            time.sleep(5)
+    loop.run(window_thread.is_alive)
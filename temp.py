@@ -262,9 +262,7 @@ def get_temp( send=False, on_time=0 ):
     if t[0] == 0.0 or t[1] == 0.0:
         shared_memory['data_fresh'] = False
         return
-    shared_memory['env_temp']   = t[0]
-    shared_memory['bath_temp']  = t[1]
-    shared_memory['data_fresh'] = True
+    shared_memory.update(env_temp=t[0], bath_temp=t[1], data_fresh=True)
 
 def window_main(*args):
     app = QtGui.QApplication(sys.argv)
@@ -279,7 +277,8 @@ if __name__ == "__main__":
 
     import PID
     from BathController import BathController
-    from multiprocessing import Process, Manager, Lock
+    from multiprocessing import Process
+    from SharedState import SharedState
     from ConfigParser import SafeConfigParser
 
     def resistance_to_watts(resistance, voltage):
@@ -304,25 +303,25 @@ if __name__ == "__main__":
 
 
 
-    manager = Manager()
     config = SafeConfigParser()
     config.read('config.conf')
-    shared_memory = manager.dict({
-                                  'env_temp':None,
-                                  'bath_temp':None,
-                                  'heatCapacity':float(config.get('Tuning', 'Heat_Capacity')),
-                                  'mass':float(config.get('Tuning', 'Mass')),
-                                  'emissivity':float(config.get('Tuning', 'Emissivity')),
-                                  'area':float(config.get('Tuning', 'Area')),
-                                  'resistance':float(config.get('Tuning', 'Resistance')),
-                                  'voltage':float(config.get('Tuning', 'Voltage')),
-                                  'p':float(config.get('Tuning', 'P')), 
-                                  'i':float(config.get('Tuning', 'I')), 
-                                  'd':float(config.get('Tuning', 'D')),
-                                  'target':None,
-                                  'start':False,
-                                  'data_fresh':False
-                                  })
+    # Lives in shared pages, inherited by the GUI process
+    shared_memory = SharedState([
+                                  ('env_temp', None),
+                                  ('bath_temp', None),
+                                  ('heatCapacity', float(config.get('Tuning', 'Heat_Capacity'))),
+                                  ('mass', float(config.get('Tuning', 'Mass'))),
+                                  ('emissivity', float(config.get('Tuning', 'Emissivity'))),
+                                  ('area', float(config.get('Tuning', 'Area'))),
+                                  ('resistance', float(config.get('Tuning', 'Resistance'))),
+                                  ('voltage', float(config.get('Tuning', 'Voltage'))),
+                                  ('p', float(config.get('Tuning', 'P'))),
+                                  ('i', float(config.get('Tuning', 'I'))),
+                                  ('d', float(config.get('Tuning', 'D'))),
+                                  ('target', None),
+                                  ('start', False),
+                                  ('data_fresh', False),
+                                  ])
 
     controller = BathController(config.get('Connection', 'Port'), 
                                 config.get('Connection', 'Baud'))
@@ -0,0 +1,70 @@
+""" Kalman against the simulated bath, python -m unittest discover tests """
+import os
+import sys
+import random
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Clock import VirtualClock
+from Kalman import Kalman
+from Physics import resistance_to_watts, boltzmann_loss
+from Plant import BathPlant
+
+
+def heat_and_hold(ir_noise=None, cycles=120, period=10):
+    """ Full power for three periods then random pulses, reading every
+        second. Returns rows of (bath, noiseless thermistor, reading,
+        estimate) from the fourth period on.
+    """
+    clock = VirtualClock(None)
+    plant = BathPlant(clock, 3.786, 4.186, 0.9, 1.7583, resistance_to_watts(30.0, 240.0),
+                      sensor_tau=20.0, noise=0.1, seed=1, ir_noise=ir_noise)
+    kalman = Kalman(measurement_noise=0.1, process_noise=0.001, sensor_lag=20.0,
+                    direct_noise=ir_noise or 0.2)
+    pulses = random.Random(2)
+    rows = []
+    for cycle in range(cycles):
+        on = period if cycle < 3 else pulses.uniform(0, 1.5)
+        loss = boltzmann_loss(plant.emissivity, plant.area, plant.bath_temp, plant.env_temp)
+        kalman.drive(clock(), plant.watts / plant.capacity, on, loss / plant.capacity)
+        plant.set_element(on * 1000)
+        for n in range(period):
+            reading = plant.temperatures()[1]
+            estimate = kalman.step(clock(), reading, plant.ir_temperature())[0]
+            if cycle >= 3:
+                rows.append((plant.bath_temp, plant.sensor_temp, reading, estimate))
+            clock.advance(1.0)
+    return numpy.array(rows).T
+
+
+class KalmanTest( unittest.TestCase ):
+
+    def test_quieter_than_the_thermistor(self):
+        bath, sensor, reading, estimate = heat_and_hold()
+        self.assertLess(numpy.diff(estimate - bath).std(), 0.5 * (reading - sensor).std())
+
+    def test_lag_is_bounded(self):
+        bath, sensor, reading, estimate = heat_and_hold()
+        # The reading trails the heat up by degrees, the estimate doesn't
+        self.assertGreater(abs(reading - bath).max(), 5.0)
+        self.assertLess(abs(estimate - bath).max(), 0.3)
+
+    def test_ir_reading_tightens_the_estimate(self):
+        without = heat_and_hold()
+        bath, sensor, reading, estimate = heat_and_hold(ir_noise=0.2)
+        rms = lambda error: numpy.sqrt((error ** 2).mean())
+        self.assertLess(rms(estimate - bath), rms(without[3] - without[0]))
+
+    def test_drive_predicts_the_pulse(self):
+        kalman = Kalman(sensor_lag=0.0)
+        kalman.step(0.0, 30.0)
+        kalman.drive(0.0, 0.5, 4.0, 0.01)
+        kalman.predict(10.0)
+        self.assertAlmostEqual(kalman.temperature, 30.0 + 0.5 * 4.0 - 0.01 * 10.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
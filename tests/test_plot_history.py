@@ -0,0 +1,75 @@
+""" The GUI plot's redraw bookkeeping, headless """
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PlotHistory import PlotHistory
+
+
+class PlotHistoryTest( unittest.TestCase ):
+
+    def setUp(self):
+        self.history = PlotHistory(capacity=1000)
+        for t in range(10):
+            self.history.add(float(t), 21.0, 30.0 + t)
+
+    def test_nothing_new_nothing_drawn(self):
+        self.assertEqual(self.history.refresh(100), 'decimated')
+        self.assertFalse(self.history.dirty)
+        self.assertIsNone(self.history.refresh(100))
+
+    def test_new_samples_are_appended(self):
+        self.history.refresh(100)
+        drawn = self.history.bath[0].copy()
+        self.history.add(10.0, 21.0, 40.0)
+        self.history.add(11.0, 21.0, 41.0)
+        self.assertTrue(self.history.dirty)
+        self.assertEqual(self.history.refresh(100), 'appended')
+        x, y = self.history.bath
+        numpy.testing.assert_array_equal(x[:len(drawn)], drawn)
+        numpy.testing.assert_array_equal(x[len(drawn):], [10.0, 11.0])
+        numpy.testing.assert_array_equal(y[len(drawn):], [40.0, 41.0])
+
+    def test_redecimated_when_resized_or_grown(self):
+        self.history.refresh(100)
+        self.history.add(10.0, 21.0, 40.0)
+        self.assertEqual(self.history.refresh(50), 'decimated')
+        # Past two points a pixel the appended tail is thinned again
+        for t in range(11, 200):
+            self.history.add(float(t), 21.0, 30.0)
+        self.assertEqual(self.history.refresh(50), 'decimated')
+        self.assertEqual(len(self.history.bath[0]), 50)
+
+    def test_reset_redraws_from_one_sample(self):
+        self.history.refresh(100)
+        self.history.reset(0.0, 21.0, 25.0)
+        self.assertEqual(self.history.refresh(100), 'decimated')
+        numpy.testing.assert_array_equal(self.history.bath[1], [25.0])
+
+    def test_samples_added_after_a_reset_are_not_appended(self):
+        self.history.refresh(100)
+        self.history.reset(0.0, 21.0, 25.0)
+        for t in range(1, 10):
+            self.history.add(float(t), 21.0, 25.0 + t)
+        self.assertEqual(self.history.refresh(100), 'decimated')
+        numpy.testing.assert_array_equal(self.history.bath[0], numpy.arange(10.0))
+        numpy.testing.assert_array_equal(self.history.bath[1], 25.0 + numpy.arange(10.0))
+
+    def test_window_only_grows_when_left(self):
+        self.history.refresh(100)
+        window = self.history.window
+        self.assertEqual(window, (0.0, 60.0, 20.0, 40.0))
+        self.history.add(10.0, 21.0, 35.0)
+        self.history.refresh(100)
+        self.assertEqual(self.history.window, window)
+        self.history.add(61.0, 21.0, 45.0)
+        self.history.refresh(100)
+        self.assertEqual(self.history.window, (0.0, 91.5, 19.0, 46.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+""" Recorder never loses an earlier run's recording """
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import Recorder
+
+
+class RecorderTest( unittest.TestCase ):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'bath.rec')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_once(self, backups, bath_temp):
+        recorder = Recorder.Recorder(self.path, 4096, backups)
+        recorder.record(time=1.0, bath_temp=bath_temp)
+        recorder.close()
+
+    def test_earlier_run_rotated(self):
+        self.run_once(2, 30.0)
+        self.run_once(2, 31.0)
+        self.assertEqual(list(Recorder.read(self.path + '.1')['bath_temp']), [30.0])
+        self.assertEqual(list(Recorder.read_all(self.path)['bath_temp']), [30.0, 31.0])
+
+    def test_earlier_run_set_aside_without_backups(self):
+        self.run_once(0, 30.0)
+        self.run_once(0, 31.0)
+        self.run_once(0, 32.0)
+        self.assertEqual(list(Recorder.read(self.path)['bath_temp']), [32.0])
+        aside = sorted(os.path.join(self.dir, f) for f in os.listdir(self.dir)
+                       if f != 'bath.rec')
+        self.assertEqual(len(aside), 2)
+        self.assertEqual(sorted(Recorder.read(p)['bath_temp'][0] for p in aside), [30.0, 31.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+""" RingBuffer wrap around """
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from RingBuffer import RingBuffer
+
+
+class RingBufferTest( unittest.TestCase ):
+
+    def test_extend_past_capacity_keeps_the_newest_in_order(self):
+        ring = RingBuffer(4, ('value',))
+        ring.extend([[1.0, 2.0, 3.0, 4.0, 5.0, 6.0]])
+        self.assertEqual(ring.latest(), (6.0,))
+        numpy.testing.assert_array_equal(ring.arrays()['value'], [3.0, 4.0, 5.0, 6.0])
+
+    def test_extend_past_capacity_after_appends(self):
+        ring = RingBuffer(4, ('value',))
+        ring.append(0.0)
+        ring.extend([numpy.arange(1.0, 8.0)])
+        ring.append(8.0)
+        numpy.testing.assert_array_equal(ring.arrays()['value'], [5.0, 6.0, 7.0, 8.0])
+
+    def test_extend_wraps(self):
+        ring = RingBuffer(4, ('value',))
+        ring.extend([[1.0, 2.0, 3.0]])
+        ring.extend([[4.0, 5.0]])
+        numpy.testing.assert_array_equal(ring.arrays()['value'], [2.0, 3.0, 4.0, 5.0])
+        numpy.testing.assert_array_equal(ring.arrays(last=2)['value'], [4.0, 5.0])
+
+
+if __name__ == '__main__':
+    unittest.main()